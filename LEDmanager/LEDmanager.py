@@ -1,14 +1,29 @@
+import argparse
+import os
+import sys
+# MyMQTT and payloads live in common/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
 from MyMQTT import MyMQTT
+from payloads import FORMATS, decode_measurement, encode_led
+from eaqi import EAQIEngine
+from sharding import HashRing
 import json
 import cherrypy
+import requests
+import threading
 import time
 class LightManager: 
-    def __init__(self, clientID, broker, port):
+    def __init__(self, clientID, broker, port, debounce=0.5, catalog_url=None, payload_format="json"):
         self.broker = broker
         self.port = port
+        self.catalog_url = catalog_url
         self.rooms = {}  # Store room configurations internally
         self.clientID = clientID
-        self.client = MyMQTT(clientID, broker, port, self)
+        # Payloads are encoded here, in JSON or in the binary format of payloads.py
+        if payload_format not in FORMATS:
+            raise ValueError(f"Unknown payload format {payload_format}")
+        self.payload_format = payload_format
+        self.client = MyMQTT(clientID, broker, port, self, serializer=None)
         self.colors = ["green", "yellow", "orange", "red", "dark purple"]
         self.eaqi_thresholds = {
             "PM2.5": [10, 20, 25, 50],
@@ -17,78 +32,188 @@ class LightManager:
             "NO2": [40, 90, 120, 230],
             "SO2": [100, 200, 350, 500]
         }
+        # Latest values and published levels of every room, classified in batches
+        self.engine = EAQIEngine(self.eaqi_thresholds)
+        # Messages received within this many seconds are coalesced into one LED update
+        self.debounce = debounce
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.publish_changes_periodically, daemon=True)
+        self._watch_thread = threading.Thread(target=self.watch_rooms, daemon=True)
+        self.rooms_version = 0
+        # Rooms are split between the running LightManager instances with a consistent
+        # hash ring; each instance announces itself with a retained message on this topic
+        self.presence_topic = f"led/instances/{clientID}"
+        self.ring = HashRing([clientID])
+        # Set once our own presence message comes back, after the retained ones of the others
+        self._presence_seen = threading.Event()
+        self.presence_timeout = 5
 
     def add_room(self, room_id):
         """Add a new room and initialize its configurations."""
-        topics_subscribe = [f"{room_id}/{pollutant}" for pollutant in ["PM2.5", "PM10", "O3", "NO2", "SO2"]]
+        if room_id in self.rooms:
+            return
         topic_publish = f"{room_id}/LED"
         self.rooms[room_id] = {
-            "topics_subscribe": topics_subscribe,
-            "topic_publish": topic_publish,
-            "latest_values": {pollutant: 0 for pollutant in ["PM2.5", "PM10", "O3", "NO2", "SO2"]},
-            "current_color": "green"
+            "topic_publish": topic_publish
         }
-        print(f"Added room {room_id} with topics: {topics_subscribe} and LED topic: {topic_publish}")
+        # Only the rooms assigned to this instance are classified here. Another
+        # instance may have been handling the room, so keep its color until every
+        # pollutant has been received
+        if self.ring.owner(room_id) == self.clientID:
+            self.engine.add_room(room_id, wait_all=True)
+        print(f"Added room {room_id} with LED topic: {topic_publish}")
+
+    def remove_room(self, room_id):
+        """Stop handling a room."""
+        if self.rooms.pop(room_id, None) is not None:
+            self.engine.remove_room(room_id)
+            print(f"Removed room {room_id}")
+
+    def rebalance(self):
+        """Take over or hand off rooms after an instance joined or left."""
+        taken, released = 0, 0
+        for room_id in list(self.rooms):
+            owned = self.ring.owner(room_id) == self.clientID
+            if owned and room_id not in self.engine:
+                # Starts from a blank state, the LED keeps the previous owner's color
+                # until the readings of every pollutant have rebuilt it
+                self.engine.add_room(room_id, wait_all=True)
+                taken += 1
+            elif not owned and room_id in self.engine:
+                self.engine.remove_room(room_id)
+                released += 1
+        print(f"Instances: {sorted(self.ring.nodes)}, took {taken} rooms, released {released}, owning {len(self.engine.rooms())}")
+
+    def update_instance(self, topic, msg):
+        instance = topic.split("/")[-1]
+        if instance == self.clientID:
+            if msg:
+                self._presence_seen.set()
+            return
+        if msg:
+            if instance in self.ring.nodes:
+                return
+            self.ring.add(instance)
+        else:
+            if instance not in self.ring.nodes:
+                return
+            self.ring.remove(instance)
+        self.rebalance()
 
     def startSim(self):
-        """Start MQTT client and subscribe to all room topics."""
+        """Start MQTT client and subscribe to the pollutant topics of every room."""
+        self.client.setWill(self.presence_topic)
         self.client.start()
-        for room_id, room_details in self.rooms.items():
-            for topic in room_details["topics_subscribe"]:
-                self.client.mySubscribe(topic)
+        self.client.mySubscribe("led/instances/+")
+        self.client.myPublish(self.presence_topic, json.dumps({"clientID": self.clientID, "timestamp": time.time()}), retain=True)
+        # The broker sends the retained presence of the other instances on subscribe,
+        # before our own message: once it is back the ring is complete and the rooms
+        # of the others are not claimed, even for a moment
+        if not self._presence_seen.wait(self.presence_timeout):
+            print(f"Own presence not received after {self.presence_timeout} s, assigning rooms with instances {sorted(self.ring.nodes)}")
+        # One wildcard subscription per pollutant whatever the number of rooms,
+        # messages are routed to their room by parsing the topic in notify
+        self.client.mySubscribeMany([f"+/{pollutant}" for pollutant in self.eaqi_thresholds])
+        if self.catalog_url:
+            self.poll_rooms(wait=0)
+            self._watch_thread.start()
+        if self.debounce:
+            self._thread.start()
+
+    def poll_rooms(self, wait):
+        """Fetch the room changes from the catalog change feed and apply them."""
+        response = requests.get(
+            f"{self.catalog_url}/rooms",
+            params={"since": self.rooms_version, "wait": wait},
+            timeout=wait + 10
+        )
+        feed = response.json()
+        if feed["reset"]:
+            room_ids = {room["roomID"] for room in feed["items"]}
+            for room_id in list(self.rooms):
+                if room_id not in room_ids:
+                    self.remove_room(room_id)
+            for room_id in room_ids:
+                self.add_room(room_id)
+        else:
+            for change in feed["changes"]:
+                if change["op"] == "put":
+                    self.add_room(change["id"])
+                else:
+                    self.remove_room(change["id"])
+        self.rooms_version = feed["version"]
+
+    def watch_rooms(self):
+        while not self._stop.is_set():
+            try:
+                self.poll_rooms(wait=30)
+            except Exception as e:
+                print(f"Error watching catalog rooms: {e}")
+                self._stop.wait(5)
 
     def stopSim(self):
         """Stop MQTT client."""
+        self._stop.set()
+        # Let the other instances take over our rooms
+        self.client.clearRetained(self.presence_topic)
         self.client.unsubscribe()
         self.client.stop()
 
     def notify(self, topic, msg):
-        print(f"Message received on topic {topic}: {msg}")
         try:
-            data = json.loads(msg)
+            if topic.startswith("led/instances/"):
+                self.update_instance(topic, msg)
+                return
             room_id, pollutant = topic.split("/")[:2]
-            if room_id in self.rooms:
-                room = self.rooms[room_id]
-                room["latest_values"][pollutant] = data["value"]
-                room["current_color"] = self.determine_led_color(room["latest_values"])
-                self.publish(room_id, room["current_color"])
+            if room_id not in self.engine:
+                # Unknown room or owned by another instance, skip the parsing
+                return
+            data = decode_measurement(msg)
+            if self.engine.update(room_id, pollutant, data["value"]) and not self.debounce:
+                self.publish_changes()
         except Exception as e:
             print(f"Error processing message: {e}")
 
-    def determine_led_color(self, latest_values):
-        # Determine the worst score across pollutants
-        worst_score = 0
-        for pollutant, thresholds in self.eaqi_thresholds.items():
-            value = latest_values.get(pollutant, 0)
-            for index, threshold in enumerate(thresholds):
-                if value > threshold:
-                    worst_score = max(worst_score, index + 1)
-        return self.colors[worst_score]
+    def publish_changes(self):
+        """Classify the rooms updated since the last call and publish the colors that changed."""
+        for room_id, level in self.engine.classify_dirty():
+            self.publish(room_id, self.colors[level])
+
+    def publish_changes_periodically(self):
+        while not self._stop.wait(self.debounce):
+            try:
+                self.publish_changes()
+            except Exception as e:
+                print(f"Error publishing LED colors: {e}")
+
+    def current_color(self, room_id):
+        level = self.engine.level(room_id)
+        return self.colors[level] if level >= 0 else None
 
     def publish(self, room_id, color):
-        message = {
-            'client': self.clientID,
-            'room_id': room_id,
-            'n': 'switch',
-            'status': color,
-            'timestamp': time.time(),
-            'unit': "color"
-        }
-        topic_publish = self.rooms[room_id]["topic_publish"]
-        self.client.myPublish(topic_publish, message)
+        message = encode_led(self.clientID, room_id, color, self.colors, time.time(), self.payload_format)
+        room = self.rooms.get(room_id)
+        if room is None:
+            # Removed from the catalog in the meantime
+            return
+        self.client.myPublish(room["topic_publish"], message)
         print(f"LED color set to {color} for room {room_id}")
 
 if __name__ == "__main__":
-    broker = "YOU NEED TO FILL IN THE BROKER ADDRESS HERE"
-    port = "YOU NEED TO FILL IN THE PORT HERE"
-    
-    light_manager = LightManager("light_manager", broker, port)
-    
-    # Dynamically add rooms
-    light_manager.add_room("room1")
-    light_manager.add_room("room2")
+    parser = argparse.ArgumentParser(description="Set the LED color of the rooms from their air quality")
+    # Every instance needs its own client ID and port, e.g. python LEDmanager.py light_manager_2 8082
+    parser.add_argument("client_id", nargs="?", default="light_manager", help="MQTT client ID of this instance")
+    # The catalog listens on 8080
+    parser.add_argument("port", nargs="?", type=int, default=int(os.environ.get("LED_PORT", 8081)), help="port of this instance")
+    parser.add_argument("--catalog", default=os.environ.get("CATALOG_URL", "http://localhost:8080"),
+                        help="catalog URL, used for the broker address and the rooms")
+    args = parser.parse_args()
+
+    # The broker and the rooms come from the catalog
+    broker_info = requests.get(f"{args.catalog}/broker").json()
+    light_manager = LightManager(args.client_id, broker_info["ip"], broker_info["port"], catalog_url=args.catalog)
     
     cherrypy.engine.subscribe('start', light_manager.startSim)
     cherrypy.engine.subscribe('stop', light_manager.stopSim)
     
-    cherrypy.quickstart(light_manager, "/", {"global": {"server.socket_host": "0.0.0.0", "server.socket_port": 8080}})
+    cherrypy.quickstart(light_manager, "/", {"global": {"server.socket_host": "0.0.0.0", "server.socket_port": args.port}})
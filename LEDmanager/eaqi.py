@@ -0,0 +1,131 @@
+import threading
+import time
+
+import numpy as np
+
+
+class EAQIEngine:
+    """Classify the European Air Quality Index of many rooms at once.
+
+    The latest value of every pollutant is kept in one (rooms x pollutants)
+    array. Updates only mark a room as dirty; classify_dirty() then computes
+    the index level of all dirty rooms in one vectorized pass and reports the
+    rooms whose level changed since it was last reported.
+
+    A room added with wait_all (taken over from another instance) is only
+    classified once every pollutant has been received, or after wait_timeout
+    seconds, so that the LED does not show a level computed from one value.
+    """
+
+    def __init__(self, thresholds, capacity=64, wait_timeout=60):
+        self.pollutants = list(thresholds)
+        self._column = {pollutant: i for i, pollutant in enumerate(self.pollutants)}
+        self._thresholds = [np.asarray(thresholds[p], dtype=np.float64) for p in self.pollutants]
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+
+        self._index = {}  # room_id -> row
+        self._room_ids = []  # row -> room_id
+        self._values = np.zeros((capacity, len(self.pollutants)), dtype=np.float64)
+        self._levels = np.zeros(capacity, dtype=np.int8)  # last reported level per room, -1 before the first
+        self._dirty = np.zeros(capacity, dtype=bool)
+        self._seen = np.zeros((capacity, len(self.pollutants)), dtype=bool)  # pollutants received per room
+        self._waiting = np.zeros(capacity, dtype=bool)
+        self._added_at = np.zeros(capacity, dtype=np.float64)
+
+    def add_room(self, room_id, wait_all=False):
+        with self._lock:
+            if room_id in self._index:
+                return
+            row = len(self._room_ids)
+            if row == len(self._values):
+                self._grow()
+            self._index[room_id] = row
+            self._room_ids.append(room_id)
+            self._values[row] = 0
+            self._levels[row] = -1
+            self._dirty[row] = False
+            self._seen[row] = False
+            self._waiting[row] = wait_all
+            self._added_at[row] = time.monotonic()
+
+    def remove_room(self, room_id):
+        """Remove a room, moving the last row into its place to keep the arrays dense."""
+        with self._lock:
+            row = self._index.pop(room_id, None)
+            if row is None:
+                return
+            last = len(self._room_ids) - 1
+            if row != last:
+                moved = self._room_ids[last]
+                self._values[row] = self._values[last]
+                self._levels[row] = self._levels[last]
+                self._dirty[row] = self._dirty[last]
+                self._seen[row] = self._seen[last]
+                self._waiting[row] = self._waiting[last]
+                self._added_at[row] = self._added_at[last]
+                self._room_ids[row] = moved
+                self._index[moved] = row
+            self._room_ids.pop()
+            self._dirty[last] = False
+            self._waiting[last] = False
+
+    def _grow(self):
+        size = len(self._values) * 2
+        self._values = np.resize(self._values, (size, len(self.pollutants)))
+        self._levels = np.resize(self._levels, size)
+        self._dirty = np.resize(self._dirty, size)
+        self._seen = np.resize(self._seen, (size, len(self.pollutants)))
+        self._waiting = np.resize(self._waiting, size)
+        self._added_at = np.resize(self._added_at, size)
+        self._dirty[len(self._room_ids):] = False
+        self._waiting[len(self._room_ids):] = False
+
+    def __contains__(self, room_id):
+        return room_id in self._index
+
+    def rooms(self):
+        return list(self._room_ids)
+
+    def update(self, room_id, pollutant, value):
+        """Store the latest value of a pollutant. Returns False for unknown rooms or pollutants."""
+        column = self._column.get(pollutant)
+        with self._lock:
+            row = self._index.get(room_id)
+            if row is None or column is None:
+                return False
+            self._values[row, column] = value
+            self._seen[row, column] = True
+            self._dirty[row] = True
+        return True
+
+    def level(self, room_id):
+        with self._lock:
+            return int(self._levels[self._index[room_id]])
+
+    def classify(self, values):
+        """Return the index level (0 = best) for each row of a (rooms x pollutants) array."""
+        levels = np.zeros(len(values), dtype=np.int8)
+        for column, thresholds in enumerate(self._thresholds):
+            # Number of thresholds strictly below the value, as in 'value > threshold'
+            np.maximum(levels, np.searchsorted(thresholds, values[:, column], side="left"), out=levels)
+        return levels
+
+    def classify_dirty(self):
+        """Classify the rooms updated since the last call, return [(room_id, level)] for those that changed."""
+        now = time.monotonic()
+        with self._lock:
+            count = len(self._room_ids)
+            # Rooms still waiting for some pollutants stay dirty until they are ready
+            ready = ~self._waiting[:count] | self._seen[:count].all(axis=1) | (now - self._added_at[:count] > self.wait_timeout)
+            rows = np.flatnonzero(self._dirty[:count] & ready)
+            if not len(rows):
+                return []
+            self._dirty[rows] = False
+            self._waiting[rows] = False
+            levels = self.classify(self._values[rows])
+            changed = levels != self._levels[rows]
+            rows = rows[changed]
+            levels = levels[changed]
+            self._levels[rows] = levels
+            return [(self._room_ids[row], int(level)) for row, level in zip(rows, levels)]
@@ -0,0 +1,48 @@
+import bisect
+import hashlib
+
+
+class HashRing:
+    """Consistent hash ring assigning rooms to LightManager instances.
+
+    Each instance is placed on the ring several times (virtual nodes) so that
+    rooms spread evenly, and adding or removing an instance only moves the
+    rooms of the ring segments next to it.
+    """
+
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        # (sorted keys, owners), replaced as a whole so readers on other threads
+        # never see a half-updated ring
+        self._ring = ([], [])
+        self.nodes = set()
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        points = list(zip(*self._ring)) + [(self._hash(f"{node}#{i}"), node) for i in range(self.replicas)]
+        self._set_points(points)
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        self._set_points([(key, owner) for key, owner in zip(*self._ring) if owner != node])
+
+    def _set_points(self, points):
+        points.sort()
+        self._ring = ([key for key, owner in points], [owner for key, owner in points])
+
+    def owner(self, key):
+        """Return the node owning a key, or None when the ring is empty."""
+        keys, owners = self._ring
+        if not keys:
+            return None
+        return owners[bisect.bisect(keys, self._hash(key)) % len(keys)]
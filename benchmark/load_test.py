@@ -0,0 +1,521 @@
+"""End-to-end load test of the MQTT pipeline.
+
+Synthetic sensors publish on a running Mosquitto at increasing rates while the
+real ingestion path of the time series db adaptor (notify -> BatchWriter ->
+ConnectionPool) and a real LightManager run in this process. For every rate
+the report gives:
+
+- adaptor: publish -> notify and publish -> row committed latency percentiles
+- led: publish of a reading -> LED command received latency percentiles
+- throughput actually reached, rows dropped by the writer, memory (RSS)
+
+Results are written as JSON so that two runs can be compared with --compare.
+
+Usage:
+    docker build -t air-broker broker && docker run -d -p 1883:1883 air-broker
+    python load_test.py --rates 500,1000,2000,5000 --duration 20 --output report.json
+    python load_test.py --db mysql --compare report.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+for directory in ("common", "time series db adaptor", "LEDmanager"):
+    sys.path.append(os.path.join(HERE, "..", directory))
+from MyMQTT import MyMQTT
+from payloads import FORMATS, decode_led, decode_measurement, encode_measurement
+from adaptor import TABLES, TimeSeriesAdaptor
+from batch_writer import BatchWriter
+from db_pool import ConnectionPool
+from LEDmanager import LightManager
+
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+class Recorder:
+    """Thread-safe collection of latency samples, in seconds, per metric."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._last = {}
+
+    def record(self, metric, latency):
+        with self._lock:
+            self._samples.setdefault(metric, []).append(latency)
+            self._last[metric] = time.time()
+
+    def record_many(self, metric, latencies):
+        with self._lock:
+            self._samples.setdefault(metric, []).extend(latencies)
+            self._last[metric] = time.time()
+
+    def count(self, metric):
+        with self._lock:
+            return len(self._samples.get(metric, []))
+
+    def last(self, metric):
+        with self._lock:
+            return self._last.get(metric)
+
+    def reset(self):
+        with self._lock:
+            self._samples = {}
+            self._last = {}
+
+    def summary(self, metric):
+        """Percentiles of a metric in milliseconds."""
+        with self._lock:
+            samples = sorted(self._samples.get(metric, []))
+        if not samples:
+            return None
+        summary = {"count": len(samples), "mean": sum(samples) / len(samples) * 1000}
+        for p in PERCENTILES:
+            summary[f"p{p:g}"] = samples[min(int(len(samples) * p / 100), len(samples) - 1)] * 1000
+        summary["max"] = samples[-1] * 1000
+        return summary
+
+
+class MemorySampler:
+    """Sample the resident memory of the process once per interval."""
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.samples = []  # (seconds since start, MB)
+        self._start = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def rss():
+        try:
+            with open("/proc/self/statm") as statm:
+                return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+        except OSError:
+            # Peak instead of current RSS where /proc is not available
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.samples.append((time.monotonic() - self._start, self.rss()))
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def report(self):
+        if not self.samples:
+            return {}
+        (t0, first), (t1, last) = self.samples[0], self.samples[-1]
+        return {
+            "startMB": first,
+            "endMB": last,
+            "peakMB": max(mb for _, mb in self.samples),
+            "growthMBPerMinute": (last - first) / (t1 - t0) * 60 if t1 > t0 else 0.0
+        }
+
+
+class SQLiteConnection:
+    """Stand-in for a mysql.connector connection when no MySQL server is available."""
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+
+    def is_connected(self):
+        return True
+
+    def cursor(self, **kwargs):
+        return SQLiteCursor(self._db.cursor())
+
+    def commit(self):
+        self._db.commit()
+
+    def rollback(self):
+        self._db.rollback()
+
+    def close(self):
+        self._db.close()
+
+
+class SQLiteCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    @staticmethod
+    def _params(row):
+        return tuple(value.isoformat(" ") if isinstance(value, datetime) else value for value in row)
+
+    def execute(self, query, params=()):
+        self._cursor.execute(query.replace("%s", "?"), self._params(params))
+
+    def executemany(self, query, rows):
+        self._cursor.executemany(query.replace("%s", "?"), [self._params(row) for row in rows])
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def close(self):
+        self._cursor.close()
+
+
+def sqlite_database():
+    """Create a throwaway SQLite database with the tables written by the adaptor."""
+    path = os.path.join(tempfile.mkdtemp(prefix="load_test_"), "timeseries.db")
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=WAL")
+    for table in TABLES.values():
+        db.execute(f"CREATE TABLE {table} (id INTEGER PRIMARY KEY, building TEXT, floor TEXT, room TEXT, value REAL, timestamp TEXT)")
+    db.close()
+    return path
+
+
+class TracingConnection:
+    """Wrap a connection to record publish -> commit latency of the rows it writes."""
+
+    def __init__(self, db, recorder):
+        self._db = db
+        self._recorder = recorder
+        self._pending = []
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def cursor(self, **kwargs):
+        return TracingCursor(self._db.cursor(**kwargs), self._pending)
+
+    def commit(self):
+        self._db.commit()
+        now = time.time()
+        # The timestamp column holds the time the sensor published the reading
+        self._recorder.record_many("commit", [now - row[4].timestamp() for row in self._pending])
+        self._pending.clear()
+
+    def rollback(self):
+        self._pending.clear()
+        self._db.rollback()
+
+
+class TracingCursor:
+    def __init__(self, cursor, pending):
+        self._cursor = cursor
+        self._pending = pending
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def executemany(self, query, rows):
+        self._cursor.executemany(query, rows)
+        self._pending.extend(rows)
+
+
+class BenchAdaptor(TimeSeriesAdaptor):
+    """The adaptor's MQTT ingestion path, without the catalog, the REST API and the rollups."""
+
+    def __init__(self, broker, port, connect, settings, recorder):
+        self.settings = settings
+        self.recorder = recorder
+        self.pool = ConnectionPool(
+            connect,
+            size=settings["dbConnection"].get("poolSize", 5),
+            timeout=settings["dbConnection"].get("poolTimeout", 5)
+        )
+        ingestion = settings.get("ingestion", {})
+        self.writer = BatchWriter(
+            self.pool,
+            batchSize=ingestion.get("batchSize", 500),
+            flushInterval=ingestion.get("flushInterval", 0.2),
+            queueSize=ingestion.get("queueSize", 10000),
+            enqueueTimeout=ingestion.get("enqueueTimeout", 0.05)
+        )
+        self.writer.start()
+        self.mqttClient = MyMQTT(f"load-test-adaptor-{os.getpid()}", broker, port, self,
+                                 qos=settings["mqttInfos"].get("qos", 1))
+        self.mqttClient.start()
+        self.mqttClient.mySubscribe("loadtest/+/+/aqi")
+
+    def notify(self, topic, payload):
+        self.recorder.record("notify", time.time() - decode_measurement(payload)["timestamp"])
+        super().notify(topic, payload)
+
+    def stopMqttClient(self):
+        self.mqttClient.stop()
+        self.writer.stop()
+        self.pool.close()
+
+
+class LEDProbe:
+    """Receive the LED commands and match them with the reading that caused them."""
+
+    def __init__(self, broker, port, colors, recorder):
+        self.colors = colors
+        self.recorder = recorder
+        self.sent = {}  # (room_id, level) -> publish time of the latest reading of that level
+        self.client = MyMQTT(f"load-test-led-probe-{os.getpid()}", broker, port, self, qos=0)
+
+    def start(self):
+        self.client.start()
+        self.client.mySubscribe("+/LED")
+
+    def notify(self, topic, payload):
+        room_id = topic.split("/")[0]
+        command = decode_led(payload, room_id, self.colors)
+        sent = self.sent.get((room_id, self.colors.index(command["status"])))
+        if sent is not None:
+            self.recorder.record("led", time.time() - sent)
+
+    def stop(self):
+        self.client.stop()
+
+
+class Publisher:
+    """Publish synthetic readings at a fixed rate, spread over ticks."""
+
+    def __init__(self, client, topics, values, fmt, tick=0.01, on_publish=None):
+        self.client = client
+        self.topics = topics
+        self.values = values  # function(message index) -> value
+        self.fmt = fmt
+        self.tick = tick
+        self.on_publish = on_publish
+
+    def run(self, rate, duration):
+        """Publish for duration seconds, return (messages sent, seconds taken)."""
+        sent = 0
+        start = time.monotonic()
+        next_tick = start
+        while True:
+            elapsed = time.monotonic() - start
+            if elapsed >= duration:
+                break
+            # Catch up with the schedule rather than the number of ticks
+            due = min(int(rate * (elapsed + self.tick)), int(rate * duration))
+            while sent < due:
+                topic = self.topics[sent % len(self.topics)]
+                value = self.values(sent)
+                now = time.time()
+                self.client.myPublish(topic, encode_measurement(now, value, self.fmt))
+                if self.on_publish:
+                    self.on_publish(topic, value, now)
+                sent += 1
+            next_tick += self.tick
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return sent, time.monotonic() - start
+
+
+def wait_for(recorder, metric, expected, timeout):
+    """Wait until a metric has expected samples or stopped growing for timeout seconds."""
+    count, since = recorder.count(metric), time.monotonic()
+    while count < expected and time.monotonic() - since < timeout:
+        time.sleep(0.1)
+        current = recorder.count(metric)
+        if current != count:
+            count, since = current, time.monotonic()
+    return count
+
+
+def run_adaptor(args, rate, recorder, adaptor, publisher):
+    recorder.reset()
+    before = adaptor.writer.stats()
+    start = time.time()
+    sent, elapsed = publisher.run(rate, args.duration)
+    committed = wait_for(recorder, "commit", sent, args.drain)
+    after = adaptor.writer.stats()
+    last_commit = recorder.last("commit") or time.time()
+    return {
+        "offeredRate": rate,
+        "sent": sent,
+        "publishRate": sent / elapsed,
+        "notified": recorder.count("notify"),
+        "committed": committed,
+        "committedRate": committed / (last_commit - start),
+        "dropped": after["dropped"] - before["dropped"],
+        "failed": after["failed"] - before["failed"],
+        "maxQueueDepth": after["maxQueueDepth"],
+        "latencyMs": {"notify": recorder.summary("notify"), "commit": recorder.summary("commit")}
+    }
+
+
+def run_led(args, rate, recorder, publisher):
+    recorder.reset()
+    sent, elapsed = publisher.run(rate, args.duration)
+    # Wait for at least one debounce period after the last reading
+    time.sleep(args.debounce)
+    received = wait_for(recorder, "led", sent, args.drain)
+    return {
+        "offeredRate": rate,
+        "sent": sent,
+        "publishRate": sent / elapsed,
+        "commands": received,
+        "latencyMs": {"led": recorder.summary("led")}
+    }
+
+
+def ceiling(steps, metric, slo, handled=None):
+    """Highest offered rate with a p99 latency under slo milliseconds and, if given, 99% of the messages handled."""
+    best = None
+    for step in steps:
+        latency = step["latencyMs"][metric]
+        if handled and step[handled] < 0.99 * step["sent"]:
+            continue
+        if latency and latency["p99"] <= slo:
+            best = step["offeredRate"]
+    return best
+
+
+def compare(report, baseline):
+    """Print the change of every step's throughput and p99 latency against a previous report."""
+    print(f"\nCompared with {baseline['startedAt']} ({baseline['environment'].get('commit')})")
+    for stage in ("adaptor", "led"):
+        previous = {step["offeredRate"]: step for step in baseline.get(stage, [])}
+        for step in report.get(stage, []):
+            old = previous.get(step["offeredRate"])
+            if old is None:
+                continue
+            for metric, latency in step["latencyMs"].items():
+                old_latency = old["latencyMs"].get(metric)
+                if latency and old_latency:
+                    change = (latency["p99"] - old_latency["p99"]) / old_latency["p99"] * 100 if old_latency["p99"] else 0.0
+                    print(f"{stage:<8}{step['offeredRate']:>8} msg/s  {metric:<7} p99 "
+                          f"{old_latency['p99']:>9.2f} -> {latency['p99']:>9.2f} ms ({change:+.0f}%)")
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the sensors -> adaptor/LED manager pipeline")
+    parser.add_argument("--broker", default="localhost:1883", help="Mosquitto address as host:port")
+    parser.add_argument("--db", default="sqlite", choices=["sqlite", "mysql"],
+                        help="sqlite: temporary database, mysql: the adaptor's dbConnection settings")
+    parser.add_argument("--stages", default="adaptor,led")
+    parser.add_argument("--rates", default="200,500,1000,2000,5000", help="messages per second, one step each")
+    parser.add_argument("--duration", type=float, default=15, help="seconds of publishing per step")
+    parser.add_argument("--drain", type=float, default=5, help="seconds to wait for the last messages")
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--format", default="json", choices=FORMATS)
+    parser.add_argument("--qos", type=int, default=None, choices=[0, 1, 2], help="defaults to the adaptor's qos")
+    parser.add_argument("--debounce", type=float, default=0.5, help="LightManager debounce in seconds")
+    parser.add_argument("--slo", type=float, default=1000, help="p99 latency in ms used for the throughput ceiling")
+    parser.add_argument("--output", default="load_test_report.json")
+    parser.add_argument("--compare", help="previous report to compare with")
+    args = parser.parse_args()
+
+    host, port = args.broker.split(":")
+    port = int(port)
+    rates = [float(rate) for rate in args.rates.split(",")]
+    stages = args.stages.split(",")
+    settings = json.load(open(os.path.join(HERE, "..", "time series db adaptor", "config-time-series-db-adaptor.json")))
+    qos = settings["mqttInfos"].get("qos", 1) if args.qos is None else args.qos
+    settings["mqttInfos"]["qos"] = qos
+
+    report = {
+        "startedAt": datetime.now().isoformat(timespec="seconds"),
+        "environment": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count()
+        },
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "ingestion": settings.get("ingestion", {})
+    }
+    recorder = Recorder()
+    memory = MemorySampler()
+    memory.start()
+    sensors = MyMQTT(f"load-test-sensors-{os.getpid()}", host, port, None, qos=qos, serializer=None)
+    sensors.start()
+
+    if "adaptor" in stages:
+        if args.db == "sqlite":
+            path = sqlite_database()
+            connect = lambda: TracingConnection(SQLiteConnection(path), recorder)
+            print(f"SQLite database in {path}")
+        else:
+            import mysql.connector
+            db_settings = settings["dbConnection"]
+            connect = lambda: TracingConnection(mysql.connector.connect(
+                host=db_settings["host"], port=db_settings["port"], user=db_settings["user"],
+                password=db_settings["password"], database=db_settings["database"]
+            ), recorder)
+        adaptor = BenchAdaptor(host, port, connect, settings, recorder)
+        time.sleep(1)
+        topics = [f"loadtest/{room % 5 + 1}/{room}/aqi" for room in range(args.rooms)]
+        publisher = Publisher(sensors, topics, lambda i: float(i % 5), args.format)
+        report["adaptor"] = []
+        for rate in rates:
+            step = run_adaptor(args, rate, recorder, adaptor, publisher)
+            report["adaptor"].append(step)
+            commit = step["latencyMs"]["commit"] or {}
+            print(f"adaptor {rate:>8.0f} msg/s: sent {step['sent']}, committed {step['committed']} "
+                  f"({step['committedRate']:.0f}/s), dropped {step['dropped']}, "
+                  f"commit p50 {commit.get('p50', 0):.1f} ms p99 {commit.get('p99', 0):.1f} ms")
+        adaptor.stopMqttClient()
+        report["adaptorCeiling"] = ceiling(report["adaptor"], "commit", args.slo, handled="committed")
+
+    if "led" in stages:
+        light_manager = LightManager(f"load-test-led-{os.getpid()}", host, port, debounce=args.debounce,
+                                     payload_format=args.format)
+        probe = LEDProbe(host, port, light_manager.colors, recorder)
+        room_ids = [f"loadtest-{room}" for room in range(args.rooms)]
+        for room_id in room_ids:
+            light_manager.add_room(room_id)
+        probe.start()
+        light_manager.startSim()
+        time.sleep(1)
+
+        # Each reading of a room switches it between green and dark purple,
+        # so every reading that is not coalesced produces an LED command
+        def on_publish(topic, value, now):
+            probe.sent[(topic.split("/")[0], 0 if value < 20 else 4)] = now
+
+        topics = [f"{room_id}/PM10" for room_id in room_ids]
+        publisher = Publisher(sensors, topics, lambda i: 5.0 if (i // len(topics)) % 2 else 150.0, args.format,
+                              on_publish=on_publish)
+        report["led"] = []
+        for rate in rates:
+            step = run_led(args, rate, recorder, publisher)
+            report["led"].append(step)
+            led = step["latencyMs"]["led"] or {}
+            print(f"led     {rate:>8.0f} msg/s: sent {step['sent']}, commands {step['commands']}, "
+                  f"p50 {led.get('p50', 0):.1f} ms p99 {led.get('p99', 0):.1f} ms")
+        light_manager.stopSim()
+        probe.stop()
+        report["ledCeiling"] = ceiling(report["led"], "led", args.slo + args.debounce * 1000)
+
+    sensors.stop()
+    memory.stop()
+    report["memory"] = memory.report()
+    report["memory"]["samples"] = memory.samples
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Report written to {args.output}")
+    print(f"Throughput ceiling: adaptor {report.get('adaptorCeiling')} msg/s, LED manager {report.get('ledCeiling')} msg/s")
+
+    if args.compare:
+        compare(report, json.load(open(args.compare)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,361 @@
+"""Throughput and latency benchmark of the catalog REST API.
+
+The catalog is filled with --rooms rooms, --devices devices and --users users,
+then --clients threads send a mix of GET/POST/PUT/PATCH/DELETE requests for
+--duration seconds. Requests/s and p50/p99 latency are reported per endpoint.
+
+By default the catalog runs in this process, in a temporary directory so that
+the JSON files and the log of the real catalog are left alone. --url targets a
+catalog that is already running instead.
+
+Profiling:
+    --profile catalog.prof   cProfile the request handlers, view with
+                             python -m pstats catalog.prof or snakeviz
+    py-spy                   py-spy record -o catalog.svg --pid <printed pid>,
+                             the catalog runs in the 'CP Server Thread' threads
+
+Usage: python benchmark_catalog.py --rooms 500 --devices 5000 --users 200 --clients 16 --duration 20
+"""
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import cherrypy
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Relative weight of every operation in the traffic mix
+MIX = {
+    "GET /broker": 5,
+    "GET /devices": 10,
+    "GET /devices/{id}": 15,
+    "GET /devices?roomID=": 10,
+    "GET /rooms": 5,
+    "GET /rooms/{id}": 10,
+    "GET /rooms?userID=": 5,
+    "GET /users/{id}": 5,
+    "POST /devices": 10,
+    "PUT /devices/{id}": 10,
+    "PATCH /devices/heartbeat": 5,
+    "DELETE /devices/{id}": 10
+}
+
+
+def room_body(i):
+    return {
+        "number": str(100 + i),
+        "floor": i % 10,
+        "buildingName": f"Building{i % 5}",
+        "openingHours": {"start": "08:00", "end": "18:00"},
+        "coordinates": {"lat": 45.065037, "lon": 7.658205}
+    }
+
+
+def device_body(i, room_id):
+    return {
+        "ip": "127.0.0.1",
+        "port": 8000 + i % 1000,
+        "endpoints": {"mqtt": {"topics": [f"Building/1/{i}/aqi"], "format": "json"}},
+        "availableResources": ["aqi"],
+        "roomID": room_id
+    }
+
+
+def user_body(i, room_ids):
+    return {"username": f"user{i}", "telegramChatID": str(i), "rooms": room_ids}
+
+
+class Profiler:
+    """cProfile the catalog's request handlers and merge the results of all worker threads."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._profiles = []
+        self._lock = threading.Lock()
+        # From Python 3.12 cProfile follows every thread but only one profiler can be active
+        self._global = cProfile.Profile() if sys.version_info >= (3, 12) else None
+
+    def install(self):
+        if self._global:
+            self._global.enable()
+            return
+        cherrypy.tools.profile_start = cherrypy.Tool("on_start_resource", self._start)
+        cherrypy.tools.profile_stop = cherrypy.Tool("on_end_request", self._stop)
+
+    def config(self):
+        return {} if self._global else {"tools.profile_start.on": True, "tools.profile_stop.on": True}
+
+    def _start(self):
+        profile = getattr(self._local, "profile", None)
+        if profile is None:
+            profile = self._local.profile = cProfile.Profile()
+            with self._lock:
+                self._profiles.append(profile)
+        profile.enable()
+
+    def _stop(self):
+        profile = getattr(self._local, "profile", None)
+        if profile is not None:
+            profile.disable()
+
+    def save(self, file_name, top=25):
+        if self._global:
+            self._global.disable()
+            profiles = [self._global]
+        else:
+            profiles = self._profiles
+        if not profiles:
+            return
+        stats = pstats.Stats(*profiles)
+        stats.dump_stats(file_name)
+        print(f"\nProfile written to {file_name}, top {top} by cumulative time:")
+        stats.sort_stats("cumulative").print_stats(top)
+
+
+def start_catalog(port, threads, profiler=None):
+    """Run a CatalogService with an empty catalog in a temporary directory."""
+    work_dir = tempfile.mkdtemp(prefix="catalog_benchmark_")
+    shutil.copy(os.path.join(HERE, "broker.json"), work_dir)
+    os.chdir(work_dir)
+    sys.path.insert(0, HERE)
+    from catalog import CatalogService
+
+    service = CatalogService()
+    conf = {
+        '/': {
+            'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
+            'tools.sessions.on': False
+        }
+    }
+    if profiler:
+        profiler.install()
+        conf['/'].update(profiler.config())
+    cherrypy.tree.mount(service, '/', conf)
+    cherrypy.config.update({
+        'server.socket_port': port,
+        'server.thread_pool': threads,
+        'log.screen': False,
+        "tools.response_headers.on": True,
+        "tools.response_headers.headers": [("Content-Type", "application/json")]
+    })
+    cherrypy.engine.start()
+    print(f"Catalog running in {work_dir}, pid {os.getpid()}")
+    return service
+
+
+def stop_catalog(service):
+    cherrypy.engine.exit()
+    service.thread_stop.set()
+    service.store.close()
+
+
+def populate(url, rooms, devices, users, clients):
+    """Create the rooms, devices and users in parallel, return their IDs and the time taken."""
+    local = threading.local()
+
+    def post(collection, body):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        response = local.session.post(f"{url}/{collection}", json=body)
+        response.raise_for_status()
+        return response.json()
+
+    def run_all(tasks):
+        results = [None] * len(tasks)
+        next_task = iter(range(len(tasks)))
+        lock = threading.Lock()
+
+        def work():
+            while True:
+                with lock:
+                    i = next(next_task, None)
+                if i is None:
+                    return
+                results[i] = tasks[i]()
+
+        workers = [threading.Thread(target=work) for _ in range(clients)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return results
+
+    start = time.monotonic()
+    room_ids = [room["roomID"] for room in run_all([lambda i=i: post("rooms", room_body(i)) for i in range(rooms)])]
+    device_ids = [device["deviceID"] for device in run_all([
+        lambda i=i: post("devices", device_body(i, room_ids[i % len(room_ids)])) for i in range(devices)
+    ])]
+    user_ids = [user["userID"] for user in run_all([
+        lambda i=i: post("users", user_body(i, random.sample(room_ids, min(3, len(room_ids))))) for i in range(users)
+    ])]
+    elapsed = time.monotonic() - start
+    print(f"Populated {rooms} rooms, {devices} devices and {users} users in {elapsed:.1f} s "
+          f"({(rooms + devices + users) / elapsed:.0f} POST/s)")
+    return room_ids, device_ids, user_ids
+
+
+class Client(threading.Thread):
+    """Send requests picked from the traffic mix until the deadline."""
+
+    def __init__(self, url, mix, room_ids, device_ids, user_ids, deadline, seed):
+        super().__init__(daemon=True)
+        self.url = url
+        self.operations = list(mix)
+        self.weights = [mix[operation] for operation in self.operations]
+        self.room_ids = room_ids
+        self.device_ids = device_ids
+        self.user_ids = user_ids
+        self.deadline = deadline
+        self.random = random.Random(seed)
+        self.session = requests.Session()
+        # Devices created by this client, deleted and updated in place of the initial ones
+        self.created = []
+        self.latencies = {operation: [] for operation in self.operations}
+        self.errors = {operation: 0 for operation in self.operations}
+
+    def request(self, operation):
+        pick = self.random.choice
+        if operation == "GET /broker":
+            return self.session.get(f"{self.url}/broker")
+        if operation == "GET /devices":
+            return self.session.get(f"{self.url}/devices")
+        if operation == "GET /devices/{id}":
+            return self.session.get(f"{self.url}/devices/{pick(self.device_ids)}")
+        if operation == "GET /devices?roomID=":
+            return self.session.get(f"{self.url}/devices", params={"roomID": pick(self.room_ids)})
+        if operation == "GET /rooms":
+            return self.session.get(f"{self.url}/rooms")
+        if operation == "GET /rooms/{id}":
+            return self.session.get(f"{self.url}/rooms/{pick(self.room_ids)}")
+        if operation == "GET /rooms?userID=":
+            return self.session.get(f"{self.url}/rooms", params={"userID": pick(self.user_ids)})
+        if operation == "GET /users/{id}":
+            return self.session.get(f"{self.url}/users/{pick(self.user_ids)}")
+        if operation == "POST /devices":
+            response = self.session.post(f"{self.url}/devices", json=device_body(self.random.randrange(10000), pick(self.room_ids)))
+            if response.ok:
+                self.created.append(response.json()["deviceID"])
+            return response
+        if operation == "PUT /devices/{id}":
+            device_id = pick(self.created) if self.created else pick(self.device_ids)
+            return self.session.put(f"{self.url}/devices/{device_id}", json=device_body(self.random.randrange(10000), pick(self.room_ids)))
+        if operation == "PATCH /devices/heartbeat":
+            return self.session.patch(f"{self.url}/devices/heartbeat", json={"deviceIDs": self.random.sample(self.device_ids, min(50, len(self.device_ids)))})
+        if operation == "DELETE /devices/{id}":
+            if not self.created:
+                return None
+            return self.session.delete(f"{self.url}/devices/{self.created.pop()}")
+
+    def run(self):
+        while time.monotonic() < self.deadline:
+            operation = self.random.choices(self.operations, self.weights)[0]
+            start = time.perf_counter()
+            try:
+                response = self.request(operation)
+            except requests.RequestException:
+                self.errors[operation] += 1
+                continue
+            if response is None:
+                continue
+            self.latencies[operation].append(time.perf_counter() - start)
+            if not response.ok:
+                self.errors[operation] += 1
+
+
+def percentile(samples, p):
+    return samples[min(int(len(samples) * p / 100), len(samples) - 1)] * 1000
+
+
+def report(clients, duration):
+    results = {}
+    total = 0
+    for operation in clients[0].operations:
+        samples = sorted(latency for client in clients for latency in client.latencies[operation])
+        if not samples:
+            continue
+        total += len(samples)
+        results[operation] = {
+            "requests": len(samples),
+            "requestsPerSecond": len(samples) / duration,
+            "p50": percentile(samples, 50),
+            "p99": percentile(samples, 99),
+            "max": samples[-1] * 1000,
+            "errors": sum(client.errors[operation] for client in clients)
+        }
+
+    print(f"\n{'endpoint':<28}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'errors':>8}")
+    for operation, result in results.items():
+        print(f"{operation:<28}{result['requests']:>10}{result['requestsPerSecond']:>10.0f}{result['p50']:>10.2f}"
+              f"{result['p99']:>10.2f}{result['max']:>10.2f}{result['errors']:>8}")
+    print(f"{'total':<28}{total:>10}{total / duration:>10.0f}")
+    return {"endpoints": results, "requests": total, "requestsPerSecond": total / duration}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the catalog REST API")
+    parser.add_argument("--url", help="benchmark a running catalog instead of starting one")
+    parser.add_argument("--port", type=int, default=8099, help="port of the catalog started by the benchmark")
+    parser.add_argument("--threads", type=int, default=30, help="CherryPy worker threads of the catalog started by the benchmark")
+    parser.add_argument("--rooms", type=int, default=200)
+    parser.add_argument("--devices", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--clients", type=int, default=16, help="concurrent client threads")
+    parser.add_argument("--duration", type=float, default=15, help="seconds of traffic")
+    parser.add_argument("--mix", help="weights overriding the default mix, e.g. 'GET /devices=50,POST /devices=5'")
+    parser.add_argument("--profile", help="write a cProfile of the catalog to this file (not with --url)")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    mix = dict(MIX)
+    if args.mix:
+        for entry in args.mix.split(","):
+            operation, weight = entry.rsplit("=", 1)
+            if operation not in MIX:
+                parser.error(f"unknown operation '{operation}', expected one of {', '.join(MIX)}")
+            mix[operation] = float(weight)
+    if args.url and args.profile:
+        parser.error("--profile needs the catalog to run in the benchmark process")
+    # The catalog started here runs in a temporary directory
+    args.profile = args.profile and os.path.abspath(args.profile)
+    args.output = args.output and os.path.abspath(args.output)
+
+    service = None
+    profiler = Profiler() if args.profile else None
+    url = args.url
+    if url is None:
+        service = start_catalog(args.port, args.threads, profiler)
+        url = f"http://127.0.0.1:{args.port}"
+
+    try:
+        room_ids, device_ids, user_ids = populate(url, args.rooms, args.devices, args.users, args.clients)
+        deadline = time.monotonic() + args.duration
+        clients = [Client(url, mix, room_ids, device_ids, user_ids, deadline, seed) for seed in range(args.clients)]
+        start = time.monotonic()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        results = report(clients, time.monotonic() - start)
+    finally:
+        if service:
+            stop_catalog(service)
+    if profiler:
+        profiler.save(args.profile)
+
+    if args.output:
+        results["config"] = {key: value for key, value in vars(args).items() if key != "output"}
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,23 @@
 import cherrypy
 import datetime
-import time
 import json
 import uuid
 import threading
 
+from response_cache import ResponseCache
+from store import CatalogStore
+
 class CatalogService:
     exposed = True
 
     def __init__(self):
         self.broker = self.load_json("broker.json")
-        self.devices = self.load_json("devices.json")
-        self.users = self.load_json("users.json")
-        self.rooms = self.load_json("rooms.json")
+        # Devices, rooms and users are indexed by ID and persisted through an append log
+        self.store = CatalogStore()
+        # Serialized GET responses, invalidated when the store changes
+        self.cache = ResponseCache()
+        # Devices that have not refreshed for this long are removed
+        self.device_ttl = 120
 
         # Flag to stop the cleaning thread
         self.thread_stop = threading.Event()
@@ -28,6 +33,12 @@ class CatalogService:
             if field not in data:
                 raise cherrypy.HTTPError(400, f"Invalid request: '{field}' is required")
 
+    @staticmethod
+    def validate_format(mqtt_endpoint):
+        """Validate the optional payload format advertised by a device."""
+        if mqtt_endpoint.get("format", "json") not in ["json", "struct"]:
+            raise cherrypy.HTTPError(400, "Invalid request: 'format' must be 'json' or 'struct'")
+
     @staticmethod
     def load_json(file_name):
         """Load JSON data from a file."""
@@ -37,57 +48,66 @@ class CatalogService:
         except FileNotFoundError:
             return []
 
-    @staticmethod
-    def save_json(file_name, data):
-        """Save JSON data to a file."""
-        with open(file_name, "w") as file:
-            json.dump(data, file, indent=4)
-
     def periodic_cleanup(self):
-        """Periodic cleanup thread to remove old devices every 2 minutes."""
+        """Cleanup thread removing devices not refreshed in the last 2 minutes."""
         while not self.thread_stop.is_set():
-            print("Running periodic cleanup...")
-            devices = CatalogService.load_json("devices.json")
-            current_time = datetime.datetime.now(datetime.UTC)
-            updated_devices = [
-                device for device in devices
-                if datetime.datetime.fromisoformat(device["insert-timestamp"]) > current_time - datetime.timedelta(minutes=2)
-            ]
-            rooms = CatalogService.load_json("rooms.json")
-            for room in rooms:
-                room["devices"] = [device for device in room["devices"] if device in [d["deviceID"] for d in updated_devices]]
-            CatalogService.save_json("devices.json", updated_devices)
-            CatalogService.save_json("rooms.json", rooms)
-            time.sleep(10)
+            expired = self.store.expire_devices(self.device_ttl)
+            if expired:
+                print(f"Removed {len(expired)} expired devices")
+            # Heartbeats are appended to the log in one line every heartbeat_flush seconds
+            self.store.flush_heartbeats()
+            # Wake up when the next device is due, but at least every 10 seconds
+            next_expiry = self.store.next_expiry(self.device_ttl)
+            self.thread_stop.wait(10 if next_expiry is None else min(next_expiry, 10))
 
     def get_item(self, collection, item_id, item_name):
         """Get an item from a collection by ID."""
-        item = next((item for item in collection if item[item_name] == item_id), None)
+        item = self.store.get(collection, item_id)
         if item:
-            return json.dumps(item).encode('utf-8')
+            return self.cache.respond(*self.cache.item(collection, item_id, item))
         raise cherrypy.HTTPError(404, f"{item_name.capitalize()} not found")
 
+    def get_collection(self, collection):
+        """Get a whole collection."""
+        return self.cache.respond(*self.cache.collection(self.store, collection))
+
+    def get_changes(self, collection, params):
+        """Serve the change feed of a collection, long-polling when 'wait' is given."""
+        try:
+            since = int(params["since"])
+            wait = min(float(params.get("wait", 0)), 30)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "Invalid request: 'since' and 'wait' must be numbers")
+        return json.dumps(self.store.changes(collection, since, wait)).encode('utf-8')
+
     def GET(self, *uri, **params):
         """Handle GET requests."""
+        if uri[0] in ["devices", "rooms", "users"] and len(uri) == 1 and "since" in params:
+            return self.get_changes(uri[0], params)
         if uri[0] == "broker":
             return json.dumps(self.broker).encode('utf-8')
+        if uri[0] == "stats":
+            return json.dumps(dict(self.store.stats(), responseCache=self.cache.stats)).encode('utf-8')
         if uri[0] == "devices":
             if len(uri) == 2:
-                return self.get_item(self.devices, uri[1], "deviceID")
-            return json.dumps(self.devices).encode('utf-8')
+                return self.get_item("devices", uri[1], "deviceID")
+            if "roomID" in params:
+                return json.dumps(self.store.devices_in_room(params["roomID"])).encode('utf-8')
+            return self.get_collection("devices")
         if uri[0] == "rooms":
             if len(uri) == 2:
-                return self.get_item(self.rooms, uri[1], "roomID")
-            return json.dumps(self.rooms).encode('utf-8')
+                return self.get_item("rooms", uri[1], "roomID")
+            if "userID" in params:
+                return json.dumps(self.store.rooms_of_user(params["userID"])).encode('utf-8')
+            return self.get_collection("rooms")
         if uri[0] == "users":
             if len(uri) == 2:
-                return self.get_item(self.users, uri[1], "userID")
-            return json.dumps(self.users).encode('utf-8')
+                return self.get_item("users", uri[1], "userID")
+            return self.get_collection("users")
 
-    def add_item(self, collection, item, file_name):
-        """Add an item to a collection and save to file."""
-        collection.append(item)
-        self.save_json(file_name, collection)
+    def add_item(self, collection, item):
+        """Add an item to a collection and record it in the log."""
+        item = self.store.put(collection, item)
         return json.dumps(item).encode('utf-8')
 
     def POST(self, *uri, **params):
@@ -97,43 +117,38 @@ class CatalogService:
             self.validate_fields(["ip", "port", "endpoints", "availableResources", "roomID"], device)
             if "mqtt" in device["endpoints"]:
                 self.validate_fields(["topics"], device["endpoints"]["mqtt"])
+                self.validate_format(device["endpoints"]["mqtt"])
             if "rest" in device["endpoints"]:
                 self.validate_fields(["restIP"], device["endpoints"]["rest"])
-            if not any(room["roomID"] == device["roomID"] for room in self.rooms):
+            if not self.store.exists("rooms", device["roomID"]):
                 raise cherrypy.HTTPError(404, "Referenced room not found")
             device["deviceID"] = str(uuid.uuid4())
             device["insert-timestamp"] = datetime.datetime.now(datetime.UTC).isoformat()
-            for room in self.rooms:
-                if room["roomID"] == device["roomID"]:
-                    room["devices"].append(device["deviceID"])
-                    break
-            self.save_json("rooms.json", self.rooms)
-            return self.add_item(self.devices, device, "devices.json")
+            # The room's device list follows from the device's roomID
+            return self.add_item("devices", device)
 
         if uri[0] == "rooms":
             room = json.loads(cherrypy.request.body.read())
             self.validate_fields(["number", "floor", "buildingName", "openingHours", "coordinates"], room)
             room["roomID"] = str(uuid.uuid4())
             room["devices"] = []
-            return self.add_item(self.rooms, room, "rooms.json")
+            return self.add_item("rooms", room)
 
         if uri[0] == "users":
             user = json.loads(cherrypy.request.body.read())
             self.validate_fields(["username", "telegramChatID", "rooms"], user)
             for roomID in user["rooms"]:
-                if not any(room["roomID"] == roomID for room in self.rooms):
+                if not self.store.exists("rooms", roomID):
                     raise cherrypy.HTTPError(404, "Referenced room not found")
             user["userID"] = str(uuid.uuid4())
-            return self.add_item(self.users, user, "users.json")
-
-    def update_item(self, collection, item, item_id, item_name, file_name):
-        """Update an item in a collection and save to file."""
-        for i, existing_item in enumerate(collection):
-            if existing_item[item_name] == item_id:
-                collection[i] = item
-                self.save_json(file_name, collection)
-                return json.dumps(item).encode('utf-8')
-        raise cherrypy.HTTPError(404, f"{item_name.capitalize()} not found")
+            return self.add_item("users", user)
+
+    def update_item(self, collection, item, item_id, item_name):
+        """Update an item in a collection and record it in the log."""
+        if not self.store.exists(collection, item_id):
+            raise cherrypy.HTTPError(404, f"{item_name.capitalize()} not found")
+        item = self.store.put(collection, item)
+        return json.dumps(item).encode('utf-8')
 
     def PUT(self, *uri, **params):
         """Handle PUT requests."""
@@ -142,57 +157,67 @@ class CatalogService:
             self.validate_fields(["ip", "port", "endpoints", "availableResources", "roomID"], device)
             if "mqtt" in device["endpoints"]:
                 self.validate_fields(["topics"], device["endpoints"]["mqtt"])
+                self.validate_format(device["endpoints"]["mqtt"])
             if "rest" in device["endpoints"]:
                 self.validate_fields(["restIP"], device["endpoints"]["rest"])
-            if not any(room["roomID"] == device["roomID"] for room in self.rooms):
+            if not self.store.exists("rooms", device["roomID"]):
                 raise cherrypy.HTTPError(404, "Referenced room not found")
             device["deviceID"] = uri[1]
             device["insert-timestamp"] = datetime.datetime.now(datetime.UTC).isoformat()
-            return self.update_item(self.devices, device, uri[1], "deviceID", "devices.json")
+            return self.update_item("devices", device, uri[1], "deviceID")
 
         if len(uri) == 2 and uri[0] == "rooms":
             room = json.loads(cherrypy.request.body.read())
             self.validate_fields(["number", "floor", "buildingName", "openingHours", "coordinates", "devices"], room)
             room["roomID"] = uri[1]
-            return self.update_item(self.rooms, room, uri[1], "roomID", "rooms.json")
+            return self.update_item("rooms", room, uri[1], "roomID")
 
         if len(uri) == 2 and uri[0] == "users":
             user = json.loads(cherrypy.request.body.read())
             self.validate_fields(["username", "telegramChatID", "rooms"], user)
             user["userID"] = uri[1]
             for roomID in user["rooms"]:
-                if not any(room["roomID"] == roomID for room in self.rooms):
+                if not self.store.exists("rooms", roomID):
                     raise cherrypy.HTTPError(404, "Referenced room not found")
-            return self.update_item(self.users, user, uri[1], "userID", "users.json")
+            return self.update_item("users", user, uri[1], "userID")
 
         raise cherrypy.HTTPError(400, "Invalid request")
 
-    def delete_item(self, collection, item_id, item_name, file_name):
-        """Delete an item from a collection and save to file."""
-        for i, item in enumerate(collection):
-            if item[item_name] == item_id:
-                del collection[i]
-                self.save_json(file_name, collection)
-                return
-        raise cherrypy.HTTPError(404, f"{item_name.capitalize()} not found")
+    def PATCH(self, *uri, **params):
+        """Handle PATCH requests."""
+        # Batch heartbeat: {"deviceIDs": [...]}
+        if len(uri) == 2 and uri[0] == "devices" and uri[1] == "heartbeat":
+            body = json.loads(cherrypy.request.body.read())
+            self.validate_fields(["deviceIDs"], body)
+            unknown = self.store.heartbeat(body["deviceIDs"])
+            return json.dumps({"refreshed": len(body["deviceIDs"]) - len(unknown), "unknown": unknown}).encode('utf-8')
+
+        if len(uri) == 3 and uri[0] == "devices" and uri[2] == "heartbeat":
+            if self.store.heartbeat([uri[1]]):
+                raise cherrypy.HTTPError(404, "Device not found")
+            device = self.store.get("devices", uri[1])
+            return json.dumps({"deviceID": uri[1], "insert-timestamp": device["insert-timestamp"]}).encode('utf-8')
+
+        raise cherrypy.HTTPError(400, "Invalid request")
+
+    def delete_item(self, collection, item_id, item_name):
+        """Delete an item from a collection and record it in the log."""
+        if self.store.delete(collection, item_id) is None:
+            raise cherrypy.HTTPError(404, f"{item_name.capitalize()} not found")
 
     def DELETE(self, *uri, **params):
         """Handle DELETE requests."""
         if len(uri) == 2 and uri[0] == "devices":
-            return self.delete_item(self.devices, uri[1], "deviceID", "devices.json")
+            return self.delete_item("devices", uri[1], "deviceID")
 
         if len(uri) == 2 and uri[0] == "rooms":
-            for i, room in enumerate(self.rooms):
-                if room["roomID"] == uri[1]:
-                    del self.rooms[i]
-                    self.devices = [d for d in self.devices if d["roomID"] != uri[1]]
-                    self.save_json("rooms.json", self.rooms)
-                    self.save_json("devices.json", self.devices)
-                    return
-            raise cherrypy.HTTPError(404, "Room not found")
+            # Also removes the room's devices and the references held by users
+            if self.store.delete_room(uri[1]) is None:
+                raise cherrypy.HTTPError(404, "Room not found")
+            return
 
         if len(uri) == 2 and uri[0] == "users":
-            return self.delete_item(self.users, uri[1], "userID", "users.json")
+            return self.delete_item("users", uri[1], "userID")
 
         raise cherrypy.HTTPError(400, "Invalid request")
 
@@ -200,7 +225,8 @@ if __name__ == '__main__':
     conf = {
         '/': {
             'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
-            'tools.sessions.on': True
+            # The API is stateless, a session per request would only cost time
+            'tools.sessions.on': False
         }
     }
 
@@ -210,12 +236,15 @@ if __name__ == '__main__':
     def shutdown():
         print("Stopping cleaning thread...")
         service.thread_stop.set()
+        service.store.close()
 
     cherrypy.engine.subscribe('stop', shutdown)
 
     cherrypy.tree.mount(service, '/', conf)
     cherrypy.config.update({
         'server.socket_port': 8080,
+        # Long-polling watchers each hold a worker thread
+        'server.thread_pool': 30,
         "tools.response_headers.on": True,
         "tools.response_headers.headers": [("Content-Type", "application/json")]
     })
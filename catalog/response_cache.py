@@ -0,0 +1,66 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import cherrypy
+
+
+class ResponseCache:
+    """Serialized JSON bodies of catalog collections and items, with their ETag."""
+
+    def __init__(self, max_items=10000):
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._collections = {}  # name -> (revision, etag, body)
+        self._items = OrderedDict()  # (name, id) -> (item, etag, body), least recently used first
+        self.stats = {"hits": 0, "misses": 0, "notModified": 0}
+
+    @staticmethod
+    def _entry(data):
+        body = json.dumps(data).encode('utf-8')
+        return '"%s"' % hashlib.sha1(body).hexdigest()[:20], body
+
+    def collection(self, store, name):
+        """Return (etag, body) for a whole collection, serializing it only when it changed."""
+        cached = self._collections.get(name)
+        if cached is not None and cached[0] == store.revisions[name]:
+            self.stats["hits"] += 1
+            return cached[1:]
+        self.stats["misses"] += 1
+        revision, items = store.snapshot(name)
+        etag, body = self._entry(items)
+        self._collections[name] = (revision, etag, body)
+        return etag, body
+
+    def item(self, name, item_id, item):
+        """Return (etag, body) for an item, reusing the cached body while the item is unchanged."""
+        key = (name, item_id)
+        with self._lock:
+            cached = self._items.get(key)
+            # The store replaces item dicts on every change, so identity tells if it is still current
+            if cached is not None and cached[0] is item:
+                self._items.move_to_end(key)
+                self.stats["hits"] += 1
+                return cached[1:]
+        self.stats["misses"] += 1
+        etag, body = self._entry(item)
+        with self._lock:
+            self._items[key] = (item, etag, body)
+            self._items.move_to_end(key)
+            if len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return etag, body
+
+    def respond(self, etag, body):
+        """Send the body, or an empty 304 when the client already has this version."""
+        cherrypy.response.headers["ETag"] = etag
+        if_none_match = cherrypy.request.headers.get("If-None-Match")
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            tags = [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+            if etag in tags or "*" in tags:
+                self.stats["notModified"] += 1
+                cherrypy.response.status = 304
+                return b""
+        return body
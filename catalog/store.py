@@ -0,0 +1,414 @@
+import datetime
+import heapq
+import json
+import os
+import threading
+import time
+from collections import deque
+
+
+class CatalogStore:
+    """In-memory catalog indexed by ID, persisted through an append-only log.
+
+    Every mutation is appended to the log as one JSON line. The JSON files are
+    only rewritten when the log is compacted, and on startup they are loaded
+    and the log is replayed on top of them. Heartbeats are collected in memory
+    and written as one "touch" line every heartbeat_flush seconds.
+    """
+
+    COLLECTIONS = {
+        "devices": ("devices.json", "deviceID"),
+        "rooms": ("rooms.json", "roomID"),
+        "users": ("users.json", "userID")
+    }
+
+    def __init__(self, log_file="catalog.log", compact_every=1000, feed_size=10000, heartbeat_flush=30):
+        self.log_file = log_file
+        self.compact_every = compact_every
+        self.heartbeat_flush = heartbeat_flush
+        self._lock = threading.RLock()
+        # Change feed: every put/delete gets the next version. Versions start from the
+        # current time in ms so that they keep growing across restarts.
+        self.version = int(time.time() * 1000)
+        self._changes = {name: deque(maxlen=feed_size) for name in self.COLLECTIONS}
+        self._feed_start = {name: self.version for name in self.COLLECTIONS}
+        # Bumped on every change of a collection, heartbeats included
+        self.revisions = {name: 0 for name in self.COLLECTIONS}
+        self._changed = threading.Condition(self._lock)
+        self._compact_lock = threading.Lock()
+        self._data = {name: {} for name in self.COLLECTIONS}
+        # Rooms whose device list changed since the last recorded change
+        self._synced_rooms = set()
+        # Secondary indexes
+        self._room_devices = {}  # roomID -> set of deviceIDs
+        self._user_rooms = {}  # userID -> set of roomIDs
+        self._room_users = {}  # roomID -> set of userIDs
+        # Expiry index: min-heap of (last seen, deviceID), entries are invalidated
+        # lazily by comparing against _last_seen
+        self._last_seen = {}  # deviceID -> epoch seconds
+        self._expiry_heap = []
+        self.expiry_stats = {"expired": 0, "lastRun": None, "lastLag": 0.0, "maxLag": 0.0}
+        # Heartbeats not written to the log yet: deviceID -> insert-timestamp
+        self._heartbeats = {}
+        self._last_flush = time.monotonic()
+
+        for name, (file_name, key) in self.COLLECTIONS.items():
+            for item in self._load_json(file_name):
+                self._data[name][item[key]] = item
+        for name in ("devices", "rooms", "users"):
+            for item in list(self._data[name].values()):
+                self._index(name, item)
+
+        self._log_entries = self._replay(self.log_file + ".old") + self._replay(self.log_file)
+        self._synced_rooms.clear()
+        self._log = open(self.log_file, "a")
+        if self._log_entries:
+            self.compact()
+
+    @staticmethod
+    def _load_json(file_name):
+        try:
+            with open(file_name, "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return []
+
+    def _replay(self, file_name):
+        """Apply the operations recorded in a log file, return how many were applied."""
+        try:
+            with open(file_name, "r") as file:
+                lines = file.readlines()
+        except FileNotFoundError:
+            return 0
+        applied = 0
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A partially written last line after a crash
+                continue
+            if entry["op"] == "put":
+                self._put(entry["collection"], entry["item"])
+            elif entry["op"] == "delete":
+                self._delete(entry["collection"], entry["id"])
+            elif entry["op"] == "touch":
+                self._refresh(entry["seen"])
+            applied += 1
+        return applied
+
+    def _write(self, entry):
+        self._log.write(json.dumps(entry) + "\n")
+        self._log.flush()
+        self._log_entries += 1
+
+    def _append(self, entry):
+        self._write(entry)
+
+        # Record the change in the feed and wake up the watchers
+        name = entry["collection"]
+        if entry["op"] == "put":
+            item_id = entry["item"][self.COLLECTIONS[name][1]]
+            self._record(name, "put", item_id)
+        else:
+            item_id = entry["id"]
+            self._record(name, "delete", item_id)
+        # The device list of a room is derived, so it is not in the log, but the
+        # watchers of /rooms need the rooms it changed
+        for roomID in self._synced_rooms:
+            if roomID in self._data["rooms"] and not (name == "rooms" and roomID == item_id):
+                self._record("rooms", "put", roomID)
+        self._synced_rooms.clear()
+        self._changed.notify_all()
+
+    def _record(self, name, op, item_id):
+        self.version += 1
+        change = {"version": self.version, "op": op, "id": item_id}
+        if op == "put":
+            change["item"] = self._data[name][item_id]
+        changes = self._changes[name]
+        if len(changes) == changes.maxlen:
+            self._feed_start[name] = changes[0]["version"]
+        changes.append(change)
+
+    # Index maintenance
+
+    def _index(self, name, item):
+        if name == "devices":
+            self._room_devices.setdefault(item["roomID"], set()).add(item["deviceID"])
+            self._sync_room_devices(item["roomID"])
+            if "insert-timestamp" in item:
+                last_seen = datetime.datetime.fromisoformat(item["insert-timestamp"]).timestamp()
+            else:
+                last_seen = time.time()
+            self._touch(item["deviceID"], last_seen)
+        elif name == "rooms":
+            # The device list of a room is derived from the devices' roomID
+            self._room_devices.setdefault(item["roomID"], set())
+            self._sync_room_devices(item["roomID"])
+        elif name == "users":
+            rooms = set(item.get("rooms", []))
+            self._user_rooms[item["userID"]] = rooms
+            for roomID in rooms:
+                self._room_users.setdefault(roomID, set()).add(item["userID"])
+
+    def _unindex(self, name, item):
+        if name == "devices":
+            self._last_seen.pop(item["deviceID"], None)
+            devices = self._room_devices.get(item["roomID"])
+            if devices is not None:
+                devices.discard(item["deviceID"])
+                self._sync_room_devices(item["roomID"])
+        elif name == "users":
+            for roomID in self._user_rooms.pop(item["userID"], set()):
+                users = self._room_users.get(roomID)
+                if users is not None:
+                    users.discard(item["userID"])
+
+    def _sync_room_devices(self, roomID):
+        """Keep the room's 'devices' list in line with the room -> devices index."""
+        room = self._data["rooms"].get(roomID)
+        if room is not None:
+            # Replace the dict instead of mutating it, readers may still hold the old one
+            room = dict(room)
+            room["devices"] = list(self._room_devices.get(roomID, ()))
+            self._data["rooms"][roomID] = room
+            self.revisions["rooms"] += 1
+            self._synced_rooms.add(roomID)
+
+    def _touch(self, deviceID, last_seen):
+        self._last_seen[deviceID] = last_seen
+        heapq.heappush(self._expiry_heap, (last_seen, deviceID))
+        # Drop stale entries once they outnumber the live ones
+        if len(self._expiry_heap) > 2 * len(self._last_seen) + 64:
+            self._expiry_heap = [(t, d) for d, t in self._last_seen.items()]
+            heapq.heapify(self._expiry_heap)
+
+    def _put(self, name, item):
+        key = self.COLLECTIONS[name][1]
+        old = self._data[name].get(item[key])
+        if old is not None:
+            self._unindex(name, old)
+        self._data[name][item[key]] = item
+        self._index(name, item)
+        self.revisions[name] += 1
+
+    def _refresh(self, seen):
+        """Set the insert-timestamp of devices from {deviceID: ISO timestamp}, unknown IDs are skipped."""
+        for deviceID, timestamp in seen.items():
+            device = self._data["devices"].get(deviceID)
+            if device is None:
+                continue
+            device = dict(device)
+            device["insert-timestamp"] = timestamp
+            self._data["devices"][deviceID] = device
+            self._touch(deviceID, datetime.datetime.fromisoformat(timestamp).timestamp())
+        self.revisions["devices"] += 1
+
+    def _delete(self, name, item_id):
+        item = self._data[name].pop(item_id, None)
+        if item is not None:
+            self.revisions[name] += 1
+            self._unindex(name, item)
+            if name == "rooms":
+                self._room_devices.pop(item_id, None)
+        return item
+
+    # Public API
+
+    def get(self, name, item_id):
+        return self._data[name].get(item_id)
+
+    def exists(self, name, item_id):
+        return item_id in self._data[name]
+
+    def list(self, name):
+        with self._lock:
+            return list(self._data[name].values())
+
+    def snapshot(self, name):
+        """Return the revision of a collection together with its items."""
+        with self._lock:
+            return self.revisions[name], list(self._data[name].values())
+
+    def devices_in_room(self, roomID):
+        with self._lock:
+            return [self._data["devices"][d] for d in self._room_devices.get(roomID, ())]
+
+    def rooms_of_user(self, userID):
+        with self._lock:
+            return [self._data["rooms"][r] for r in self._user_rooms.get(userID, ()) if r in self._data["rooms"]]
+
+    def put(self, name, item):
+        """Insert or replace an item and record it in the log."""
+        with self._lock:
+            self._put(name, item)
+            self._append({"op": "put", "collection": name, "item": item})
+            item = self._data[name][item[self.COLLECTIONS[name][1]]]
+        self._maybe_compact()
+        return item
+
+    def delete(self, name, item_id):
+        """Remove an item and record it in the log, return None if it did not exist."""
+        with self._lock:
+            item = self._delete(name, item_id)
+            if item is None:
+                return None
+            self._append({"op": "delete", "collection": name, "id": item_id})
+        self._maybe_compact()
+        return item
+
+    def delete_room(self, roomID):
+        """Remove a room together with its devices and drop it from the users referencing it."""
+        with self._lock:
+            if roomID not in self._data["rooms"]:
+                return None
+            for deviceID in list(self._room_devices.get(roomID, ())):
+                self.delete("devices", deviceID)
+            for userID in list(self._room_users.pop(roomID, ())):
+                user = dict(self._data["users"][userID])
+                user["rooms"] = [r for r in user["rooms"] if r != roomID]
+                self.put("users", user)
+            return self.delete("rooms", roomID)
+
+    def changes(self, name, since, timeout=0):
+        """Return the changes of a collection made after version `since`.
+
+        Waits up to `timeout` seconds for a change when there is none yet. If
+        the feed no longer goes back to `since` (or `since` comes from before a
+        restart) the whole collection is returned with "reset" set.
+        """
+        with self._changed:
+            def pending():
+                changes = self._changes[name]
+                return since < self._feed_start[name] or since > self.version or (changes and changes[-1]["version"] > since)
+
+            if timeout:
+                self._changed.wait_for(pending, timeout)
+
+            if since < self._feed_start[name] or since > self.version:
+                return {"version": self.version, "reset": True, "items": list(self._data[name].values())}
+            changes = []
+            for change in reversed(self._changes[name]):
+                if change["version"] <= since:
+                    break
+                changes.append(change)
+            changes.reverse()
+            return {"version": self.version, "reset": False, "changes": changes}
+
+    def heartbeat(self, deviceIDs):
+        """Refresh the last-seen time of devices, written to the log by flush_heartbeats().
+
+        Returns the IDs that are not in the catalog.
+        """
+        timestamp = datetime.datetime.now(datetime.UTC).isoformat()
+        with self._lock:
+            unknown = [deviceID for deviceID in deviceIDs if deviceID not in self._data["devices"]]
+            seen = {deviceID: timestamp for deviceID in deviceIDs if deviceID in self._data["devices"]}
+            if seen:
+                self._refresh(seen)
+                self._heartbeats.update(seen)
+        return unknown
+
+    def flush_heartbeats(self, force=False):
+        """Write the heartbeats received since the last flush as one log line.
+
+        Does nothing until heartbeat_flush seconds have passed, unless forced.
+        """
+        with self._lock:
+            if not self._heartbeats or (not force and time.monotonic() - self._last_flush < self.heartbeat_flush):
+                return
+            # Devices deleted since their heartbeat are dropped by the replay anyway
+            self._write({"op": "touch", "collection": "devices", "seen": self._heartbeats})
+            self._heartbeats = {}
+            self._last_flush = time.monotonic()
+        self._maybe_compact()
+
+    # Expiry
+
+    def expire_devices(self, ttl):
+        """Remove the devices not seen for more than ttl seconds and return them.
+
+        Only the expired entries are popped from the heap, so a run costs
+        O(k log n) for k expired devices.
+        """
+        expired = []
+        with self._lock:
+            now = time.time()
+            lag = 0.0
+            while self._expiry_heap and self._expiry_heap[0][0] <= now - ttl:
+                last_seen, deviceID = heapq.heappop(self._expiry_heap)
+                if self._last_seen.get(deviceID) != last_seen:
+                    # The device was refreshed or deleted since this entry was pushed
+                    continue
+                lag = max(lag, now - (last_seen + ttl))
+                expired.append(self.delete("devices", deviceID))
+            self.expiry_stats["expired"] += len(expired)
+            self.expiry_stats["lastRun"] = now
+            self.expiry_stats["lastLag"] = lag
+            self.expiry_stats["maxLag"] = max(self.expiry_stats["maxLag"], lag)
+        return expired
+
+    def next_expiry(self, ttl):
+        """Return the number of seconds until the next device can expire, or None."""
+        with self._lock:
+            while self._expiry_heap:
+                last_seen, deviceID = self._expiry_heap[0]
+                if self._last_seen.get(deviceID) == last_seen:
+                    return max(last_seen + ttl - time.time(), 0)
+                heapq.heappop(self._expiry_heap)
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "devices": len(self._data["devices"]),
+                "rooms": len(self._data["rooms"]),
+                "users": len(self._data["users"]),
+                "logEntries": self._log_entries,
+                "pendingHeartbeats": len(self._heartbeats),
+                "expiryHeapSize": len(self._expiry_heap),
+                "expiry": dict(self.expiry_stats)
+            }
+
+    # Compaction
+
+    def _maybe_compact(self):
+        if self._log_entries >= self.compact_every:
+            self.compact(blocking=False)
+
+    def compact(self, blocking=True):
+        """Rewrite the JSON files from memory and start a new, empty log."""
+        if not self._compact_lock.acquire(blocking):
+            # Another thread is already compacting
+            return
+        try:
+            self._compact()
+        finally:
+            self._compact_lock.release()
+
+    def _compact(self):
+        with self._lock:
+            if not self._log_entries and not self._heartbeats:
+                return
+            # Items are replaced, never mutated, so the copied lists can be
+            # serialized after releasing the lock
+            items = {file_name: list(self._data[name].values()) for name, (file_name, key) in self.COLLECTIONS.items()}
+            # Keep the old log until the snapshots are safely on disk
+            self._log.close()
+            os.replace(self.log_file, self.log_file + ".old")
+            self._log = open(self.log_file, "a")
+            self._log_entries = 0
+            # The snapshot holds the pending heartbeats
+            self._heartbeats = {}
+            self._last_flush = time.monotonic()
+
+        for file_name, values in items.items():
+            with open(file_name + ".tmp", "w") as file:
+                json.dump(values, file, indent=4)
+            os.replace(file_name + ".tmp", file_name)
+        os.remove(self.log_file + ".old")
+
+    def close(self):
+        self.compact()
+        with self._lock:
+            self._log.close()
@@ -0,0 +1,125 @@
+import json
+import queue
+import threading
+
+import paho.mqtt.client as PahoMQTT
+
+
+class MyMQTT:
+    """MQTT client shared by the services.
+
+    - qos: default QoS of publish/subscribe, each call can override it
+    - serializer: turns the published message into the payload (json.dumps by
+      default, None to publish str/bytes as they are)
+    - workers: 0 calls notifier.notify on the network thread; with N > 0 the
+      messages are handed to N worker threads, the messages of one topic always
+      going to the same worker so that their order is kept
+    """
+
+    def __init__(self, clientID, broker, port, notifier, qos=1, serializer=json.dumps, workers=0, queueSize=10000):
+        self.broker = broker
+        self.port = port
+        self.notifier = notifier
+        self.clientID = clientID
+        self.qos = qos
+        self.serializer = serializer
+        self._topics = {}  # topic -> qos, subscribed again after a reconnection
+        self._isSubscriber = False
+        # create an instance of paho.mqtt.client
+        self._paho_mqtt = PahoMQTT.Client(clientID, True)
+        self._paho_mqtt.reconnect_delay_set(min_delay=1, max_delay=60)
+        # register the callback
+        self._paho_mqtt.on_connect = self.myOnConnect
+        self._paho_mqtt.on_disconnect = self.myOnDisconnect
+        self._paho_mqtt.on_message = self.myOnMessageReceived
+
+        self._queues = [queue.Queue(maxsize=queueSize) for _ in range(workers)]
+        self._workers = [threading.Thread(target=self._work, args=(q,), daemon=True) for q in self._queues]
+
+    def myOnConnect(self, paho_mqtt, userdata, flags, rc):
+        print("Connected to %s with result code: %d" % (self.broker, rc))
+        if rc == 0 and self._topics:
+            # the session is not kept by the broker, subscribe again after a reconnection
+            self._paho_mqtt.subscribe(list(self._topics.items()))
+
+    def myOnDisconnect(self, paho_mqtt, userdata, rc):
+        if rc != 0:
+            print("Unexpected disconnection from %s (%d), reconnecting..." % (self.broker, rc))
+
+    def myOnMessageReceived(self, paho_mqtt, userdata, msg):
+        # A new message is received
+        if self._queues:
+            # blocks the network loop when the workers fall behind
+            self._queues[hash(msg.topic) % len(self._queues)].put((msg.topic, msg.payload))
+        else:
+            self.notifier.notify(msg.topic, msg.payload)
+
+    def _work(self, messages):
+        while True:
+            topic, payload = messages.get()
+            if topic is None:
+                break
+            try:
+                self.notifier.notify(topic, payload)
+            except Exception as e:
+                print("Error handling message on %s: %s" % (topic, e))
+
+    def myPublish(self, topic, msg, qos=None, retain=False):
+        # publish a message with a certain topic
+        payload = self.serializer(msg) if self.serializer else msg
+        self._paho_mqtt.publish(topic, payload, self.qos if qos is None else qos, retain)
+
+    def clearRetained(self, topic):
+        # an empty retained message removes the one kept by the broker
+        self._paho_mqtt.publish(topic, "", 1, True)
+
+    def setWill(self, topic):
+        # the broker clears this retained topic if we disconnect abruptly, must be called before start
+        self._paho_mqtt.will_set(topic, "", 1, True)
+
+    def mySubscribe(self, topic, qos=None):
+        # subscribe for a topic
+        self.mySubscribeMany([topic], qos)
+
+    def mySubscribeMany(self, topics, qos=None):
+        # subscribe for several topics with a single SUBSCRIBE packet
+        topics = [(topic, self.qos if qos is None else qos) for topic in topics]
+        if not topics:
+            return
+        self._paho_mqtt.subscribe(topics)
+        # just to remember that it works also as a subscriber
+        self._isSubscriber = True
+        self._topics.update(topics)
+        print("subscribed to %s" % (", ".join(topic for topic, _ in topics)))
+
+    def myUnsubscribe(self, topic):
+        # unsubscribe from a single topic
+        self._paho_mqtt.unsubscribe(topic)
+        self._topics.pop(topic, None)
+        print("unsubscribed from %s" % (topic))
+
+    def start(self):
+        # manage connection to broker
+        for worker in self._workers:
+            worker.start()
+        self._paho_mqtt.connect(self.broker, self.port)
+        self._paho_mqtt.loop_start()
+
+    def unsubscribe(self):
+        if (self._isSubscriber):
+            # remember to unsuscribe if it is working also as subscriber
+            if self._topics:
+                self._paho_mqtt.unsubscribe(list(self._topics))
+            self._topics = {}
+
+    def stop(self):
+        self.unsubscribe()
+
+        self._paho_mqtt.loop_stop()
+        self._paho_mqtt.disconnect()
+        # let the workers finish the messages already received
+        for messages in self._queues:
+            messages.put((None, None))
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.join()
@@ -0,0 +1,42 @@
+"""Compare the size and encode/decode cost of the JSON and binary payload formats.
+
+Usage: python benchmark_payloads.py [iterations]
+"""
+import sys
+import time
+
+from payloads import FORMATS, decode_led, decode_measurement, encode_led, encode_measurement
+
+COLORS = ["green", "yellow", "orange", "red", "dark purple"]
+
+
+def measure(function, iterations):
+    """Return the mean cost of a call in microseconds."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main(iterations):
+    timestamp = time.time()
+    print(f"{'message':<12}{'format':<8}{'bytes':>7}{'encode us':>12}{'decode us':>12}")
+    for fmt in FORMATS:
+        payload = encode_measurement(timestamp, 23.456789, fmt)
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        encode = measure(lambda: encode_measurement(timestamp, 23.456789, fmt), iterations)
+        decode = measure(lambda: decode_measurement(payload), iterations)
+        print(f"{'measurement':<12}{fmt:<8}{len(payload):>7}{encode:>12.2f}{decode:>12.2f}")
+
+    for fmt in FORMATS:
+        payload = encode_led("light_manager", "room-uuid", "orange", COLORS, timestamp, fmt)
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        encode = measure(lambda: encode_led("light_manager", "room-uuid", "orange", COLORS, timestamp, fmt), iterations)
+        decode = measure(lambda: decode_led(payload, "room-uuid", COLORS), iterations)
+        print(f"{'led':<12}{fmt:<8}{len(payload):>7}{encode:>12.2f}{decode:>12.2f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,59 @@
+import json
+import struct
+
+# Payload formats a device can advertise in its catalog entry, under endpoints.mqtt.format
+FORMATS = ["json", "struct"]
+
+# Binary payloads start with a byte that never begins a JSON document,
+# so consumers can decode both formats without knowing the sender
+MAGIC_MEASUREMENT = b"\x01"
+MAGIC_LED = b"\x02"
+
+# Sensor reading: timestamp (float64), value (float64)
+MEASUREMENT = struct.Struct("<dd")
+# LED command: timestamp (float64), color index (uint8), followed by the client ID in UTF-8
+LED = struct.Struct("<dB")
+
+
+def encode_measurement(timestamp, value, fmt="json"):
+    """Encode a {"timestamp", "value"} reading. Non-numeric values always use JSON."""
+    if fmt == "struct" and isinstance(value, (int, float)):
+        return MAGIC_MEASUREMENT + MEASUREMENT.pack(timestamp, value)
+    return json.dumps({"timestamp": timestamp, "value": value})
+
+
+def decode_measurement(payload):
+    """Decode a reading published in any of the formats, return {"timestamp", "value"}."""
+    if payload[:1] == MAGIC_MEASUREMENT:
+        timestamp, value = MEASUREMENT.unpack_from(payload, 1)
+        return {"timestamp": timestamp, "value": value}
+    return json.loads(payload)
+
+
+def encode_led(client, room_id, color, colors, timestamp, fmt="json"):
+    """Encode an LED command; in the binary format the room comes from the topic."""
+    if fmt == "struct":
+        return MAGIC_LED + LED.pack(timestamp, colors.index(color)) + client.encode("utf-8")
+    return json.dumps({
+        'client': client,
+        'room_id': room_id,
+        'n': 'switch',
+        'status': color,
+        'timestamp': timestamp,
+        'unit': "color"
+    })
+
+
+def decode_led(payload, room_id, colors):
+    """Decode an LED command published in any of the formats."""
+    if payload[:1] == MAGIC_LED:
+        timestamp, color = LED.unpack_from(payload, 1)
+        return {
+            'client': payload[1 + LED.size:].decode("utf-8"),
+            'room_id': room_id,
+            'n': 'switch',
+            'status': colors[color],
+            'timestamp': timestamp,
+            'unit': "color"
+        }
+    return json.loads(payload)
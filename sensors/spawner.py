@@ -0,0 +1,197 @@
+"""Sensor spawner: simulates rooms x measures virtual sensors from a single process.
+
+Every room of a simulated building gets one device per measure, registered in
+the catalog and kept alive with batch heartbeats. Readings are drawn from a
+Weibull distribution for a whole slice of rooms at once and published on
+'{building}/{floor}/{room}/{measure}' (see --topic).
+
+Usage: python spawner.py --rooms 1000 --interval 1 --catalog http://localhost:8080
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import requests
+
+# MyMQTT and payloads live in common/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from MyMQTT import MyMQTT
+from payloads import FORMATS, encode_measurement
+
+# Weibull (shape, scale) of each measure
+WEIBULL = {
+    "PM2.5": (2, 15),
+    "PM10": (2, 30),
+    "O3": (2, 80),
+    "NO2": (2, 50),
+    "SO2": (2, 120),
+    "aqi": (2, 2)
+}
+
+
+class SensorSpawner:
+    def __init__(self, broker, port, building, rooms, floors, measures, interval, tick, topic, fmt, qos, catalog_url=None):
+        self.broker = broker
+        self.port = port
+        self.building = building
+        self.measures = measures
+        self.interval = interval
+        self.tick = tick
+        self.topic = topic
+        self.fmt = fmt
+        self.qos = qos
+        self.catalog_url = catalog_url
+        self.session = requests.Session()
+        self.rng = np.random.default_rng()
+        self._stop = threading.Event()
+
+        self.shapes = np.array([WEIBULL[m][0] for m in measures], dtype=np.float64)
+        self.scales = np.array([WEIBULL[m][1] for m in measures], dtype=np.float64)
+        self.rooms = []
+        for i in range(rooms):
+            number = str(100 * (i % floors + 1) + i // floors)
+            # roomID is replaced by the catalog's when the rooms are registered
+            self.rooms.append({"number": number, "floor": i % floors + 1, "roomID": f"{building}-{number}"})
+        self.deviceIDs = []
+        self.published = 0
+
+    def notify(self, topic, payload):
+        pass
+
+    def register(self):
+        """Create the rooms and one device per room and measure in the catalog."""
+        for room in self.rooms:
+            response = self.session.post(f"{self.catalog_url}/rooms", json={
+                "number": room["number"],
+                "floor": room["floor"],
+                "buildingName": self.building,
+                "openingHours": {"start": "08:00", "end": "18:00"},
+                "coordinates": {"lat": 45.065037, "lon": 7.658205}
+            })
+            response.raise_for_status()
+            room["roomID"] = response.json()["roomID"]
+            for measure in self.measures:
+                response = self.session.post(f"{self.catalog_url}/devices", json={
+                    "ip": "127.0.0.1",
+                    "port": 0,
+                    "endpoints": {"mqtt": {"topics": [self.topic_for(room, measure)], "format": self.fmt}},
+                    "availableResources": [measure],
+                    "roomID": room["roomID"]
+                })
+                response.raise_for_status()
+                self.deviceIDs.append(response.json()["deviceID"])
+        print(f"Registered {len(self.rooms)} rooms and {len(self.deviceIDs)} devices")
+
+    def heartbeat_periodically(self, every=60):
+        """Refresh the registered devices every `every` seconds, also while register() is still running.
+
+        The catalog drops devices after 120 s, registering a large fleet can take longer.
+        """
+        # register() uses self.session from the other thread
+        session = requests.Session()
+        while True:
+            deviceIDs = list(self.deviceIDs)
+            if deviceIDs:
+                try:
+                    response = session.patch(f"{self.catalog_url}/devices/heartbeat", json={"deviceIDs": deviceIDs})
+                    unknown = response.json()["unknown"]
+                    if unknown:
+                        print(f"{len(unknown)} devices are no longer in the catalog")
+                except Exception as e:
+                    print(f"Error sending heartbeats: {e}")
+            if self._stop.wait(every):
+                break
+
+    def topic_for(self, room, measure):
+        return self.topic.format(building=self.building, floor=room["floor"], room=room["number"],
+                                 roomID=room["roomID"], measure=measure)
+
+    def run(self, duration=None):
+        client = MyMQTT(f"sensor_spawner_{os.getpid()}", self.broker, self.port, self, qos=self.qos, serializer=None)
+        client.start()
+        try:
+            self._publish_loop(client, duration)
+        finally:
+            client.stop()
+
+    def _publish_loop(self, client, duration):
+        # Topics never change, build them once
+        topics = [[self.topic_for(room, measure) for measure in self.measures] for room in self.rooms]
+        # Each tick publishes one slice of the rooms so the load is spread over the interval
+        slices = np.array_split(np.arange(len(self.rooms)), max(int(round(self.interval / self.tick)), 1))
+
+        start = time.monotonic()
+        next_tick = start
+        last_report, last_published = start, 0
+        tick = 0
+        while not self._stop.is_set() and (duration is None or time.monotonic() - start < duration):
+            rows = slices[tick % len(slices)]
+            if len(rows):
+                # One vectorized draw for every sensor of the slice
+                values = self.rng.weibull(self.shapes, size=(len(rows), len(self.measures))) * self.scales
+                now = time.time()
+                for row, room_values in zip(rows.tolist(), values.tolist()):
+                    for topic, value in zip(topics[row], room_values):
+                        client.myPublish(topic, encode_measurement(now, value, self.fmt))
+                self.published += values.size
+
+            tick += 1
+            next_tick += self.tick
+            if time.monotonic() - last_report >= 10:
+                now = time.monotonic()
+                print(f"{(self.published - last_published) / (now - last_report):.0f} msgs/s")
+                last_report, last_published = now, self.published
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                self._stop.wait(delay)
+
+        print(f"Published {self.published} messages in {time.monotonic() - start:.1f} s")
+
+    def stop(self):
+        self._stop.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate many air quality sensors")
+    parser.add_argument("--catalog", default="http://localhost:8080", help="catalog URL, used for the broker address and registration")
+    parser.add_argument("--broker", help="broker address as host:port, instead of asking the catalog")
+    parser.add_argument("--no-register", action="store_true", help="do not register rooms and devices in the catalog")
+    parser.add_argument("--building", default="SimBuilding")
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--floors", type=int, default=5)
+    parser.add_argument("--measures", default=",".join(WEIBULL), help="comma separated, among " + ", ".join(WEIBULL))
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between two readings of a sensor")
+    parser.add_argument("--tick", type=float, default=0.05, help="scheduler tick in seconds")
+    parser.add_argument("--topic", default="{building}/{floor}/{room}/{measure}",
+                        help="topic template, e.g. '{roomID}/{measure}' for the LED manager")
+    parser.add_argument("--format", default="json", choices=FORMATS)
+    parser.add_argument("--qos", type=int, default=0, choices=[0, 1, 2])
+    parser.add_argument("--duration", type=float, help="stop after this many seconds")
+    args = parser.parse_args()
+
+    if args.broker:
+        broker, port = args.broker.split(":")
+    else:
+        broker_info = requests.get(f"{args.catalog}/broker").json()
+        broker, port = broker_info["ip"], broker_info["port"]
+
+    spawner = SensorSpawner(broker, int(port), args.building, args.rooms, args.floors, args.measures.split(","),
+                            args.interval, args.tick, args.topic, args.format, args.qos, args.catalog)
+
+    if not args.no_register:
+        threading.Thread(target=spawner.heartbeat_periodically, daemon=True).start()
+        spawner.register()
+
+    print(f"Simulating {args.rooms * len(spawner.measures)} sensors, {args.rooms * len(spawner.measures) / args.interval:.0f} msgs/s")
+    try:
+        spawner.run(args.duration)
+    except KeyboardInterrupt:
+        spawner.stop()
+        print("Program stopped.")
+
+
+if __name__ == "__main__":
+    main()
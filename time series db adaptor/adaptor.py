@@ -1,11 +1,35 @@
+import csv
+import io
 import json
+import os
+import sys
+import threading
+from contextlib import ExitStack
 import requests
 from datetime import datetime, timedelta
 
 import cherrypy
 import mysql.connector
 
-from MyMQTT import *
+# MyMQTT and payloads live in common/ (copied next to this file in the Docker image)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from MyMQTT import MyMQTT
+from payloads import decode_measurement
+from batch_writer import BatchWriter
+from db_pool import ConnectionPool
+from rollup import ROLLUP_AGGREGATES, RollupManager
+
+# Endpoint / measure type -> table
+TABLES = {"aqi": "air_quality_index", "windows": "windows", "ventilation": "ventilation"}
+
+# Aggregations available on GET with 'bucket'
+AGGREGATES = {"avg": "AVG(value)", "min": "MIN(value)", "max": "MAX(value)", "count": "COUNT(*)"}
+BUCKET_SECONDS = {"m": 60, "h": 3600, "d": 86400}
+TIME_UNITS = {"m": "MINUTE", "h": "HOUR", "d": "DAY", "y": "YEAR"}
+
+# Streaming export formats
+STREAM_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+STREAM_CHUNK_ROWS = 1000
 
 class TimeSeriesAdaptor:
     exposed = True
@@ -13,7 +37,46 @@ class TimeSeriesAdaptor:
     def __init__(self):
         self.settings = json.load(open('config-time-series-db-adaptor.json'))
 
-        self.db = mysql.connector.connect(
+        # Each request or batch checks out its own connection from the pool
+        self.pool = ConnectionPool(
+            self._connect,
+            size=self.settings["dbConnection"].get("poolSize", 5),
+            timeout=self.settings["dbConnection"].get("poolTimeout", 5)
+        )
+
+        # Rows received over MQTT are written in batches by a separate thread
+        ingestion = self.settings.get("ingestion", {})
+        self.writer = BatchWriter(
+            self.pool,
+            batchSize=ingestion.get("batchSize", 500),
+            flushInterval=ingestion.get("flushInterval", 0.2),
+            queueSize=ingestion.get("queueSize", 10000),
+            enqueueTimeout=ingestion.get("enqueueTimeout", 0.05)
+        )
+        self.writer.start()
+
+        # Minute/hour/day rollups of the AQI and retention of old data
+        rollup = self.settings.get("rollup", {})
+        self.rollups = RollupManager(
+            self.pool,
+            list(TABLES.values()),
+            interval=rollup.get("interval", 60),
+            grace=rollup.get("grace", 120),
+            partitionDaysAhead=rollup.get("partitionDaysAhead", 3),
+            retentionDays=rollup.get("retentionDays")
+        )
+        self.rollups.start()
+
+        self._get_broker()
+        self.mqttClient = MyMQTT(
+            self.settings["mqttInfos"]["clientId"], self.brokerIp, self.brokerPort, self,
+            qos=self.settings["mqttInfos"].get("qos", 1)
+        )
+        self.mqttClient.start()
+        self._subscribe_to_all_devices()
+
+    def _connect(self):
+        return mysql.connector.connect(
             host=self.settings["dbConnection"]["host"],
             port=self.settings["dbConnection"]["port"],
             user=self.settings["dbConnection"]["user"],
@@ -21,11 +84,6 @@ class TimeSeriesAdaptor:
             database=self.settings["dbConnection"]["database"]
         )
 
-        self._get_broker()
-        self.mqttClient = MyMQTT(self.settings["mqttInfos"]["clientId"], self.brokerIp, self.brokerPort, self)
-        self.mqttClient.start()
-        self._subscribe_to_all_devices()
-
     def _get_broker(self):
         self.catalog_ip = self.settings["catalog"]["ip"]
         self.catalog_port = self.settings["catalog"]["port"]
@@ -35,21 +93,84 @@ class TimeSeriesAdaptor:
         self.brokerPort = broker_info["port"]
 
     def _subscribe_to_all_devices(self):
-        response = requests.get(f"http://{self.catalog_ip}:{self.catalog_port}/devices")
-        devices = response.json()
+        """Subscribe to the topics of every device, then follow the catalog change feed."""
+        self.deviceTopics = {}  # deviceID -> topics
+        self.topicDevices = {}  # topic -> deviceIDs publishing on it
+        self.devicesVersion = 0
+        self._poll_devices(wait=0)
+
+        self.watchStop = threading.Event()
+        self.watchThread = threading.Thread(target=self._watch_devices, daemon=True)
+        self.watchThread.start()
+
+    def _watch_devices(self):
+        while not self.watchStop.is_set():
+            try:
+                self._poll_devices(wait=30)
+            except Exception as e:
+                print(f"Error watching catalog devices: {e}")
+                self.watchStop.wait(5)
+
+    def _poll_devices(self, wait):
+        """Long-poll the catalog for device changes and apply them."""
+        new_topics = []
+        response = requests.get(
+            f"http://{self.catalog_ip}:{self.catalog_port}/devices",
+            params={"since": self.devicesVersion, "wait": wait},
+            timeout=wait + 10
+        )
+        feed = response.json()
+
+        if feed["reset"]:
+            # The catalog could not send a delta, compare against the full list
+            devices = {device["deviceID"]: device for device in feed["items"]}
+            for deviceID in list(self.deviceTopics):
+                if deviceID not in devices:
+                    self._remove_device(deviceID)
+            for device in devices.values():
+                self._add_device(device, new_topics)
+        else:
+            for change in feed["changes"]:
+                if change["op"] == "put":
+                    self._add_device(change["item"], new_topics)
+                else:
+                    self._remove_device(change["id"])
+        # One SUBSCRIBE packet for all the new topics
+        self.mqttClient.mySubscribeMany(new_topics)
+        self.devicesVersion = feed["version"]
+
+    def _add_device(self, device, new_topics):
+        topics = device["endpoints"].get("mqtt", {}).get("topics", [])
+        if self.deviceTopics.get(device["deviceID"]) == topics:
+            return
+        self._remove_device(device["deviceID"])
+        self.deviceTopics[device["deviceID"]] = topics
+        for topic in topics:
+            devices = self.topicDevices.setdefault(topic, set())
+            if not devices:
+                new_topics.append(topic)
+            devices.add(device["deviceID"])
 
-        for device in devices:
-            topics = device["endpoints"]["mqtt"]["topics"]
-            for topic in topics:
-                self.mqttClient.mySubscribe(topic)
+    def _remove_device(self, deviceID):
+        for topic in self.deviceTopics.pop(deviceID, []):
+            devices = self.topicDevices.get(topic, set())
+            devices.discard(deviceID)
+            if not devices:
+                # No device publishes on this topic anymore
+                self.topicDevices.pop(topic, None)
+                self.mqttClient.myUnsubscribe(topic)
 
     def _fetch_results(self, query, params=None):
-        cursor = self.db.cursor(dictionary=True)
-        cursor.execute(query, params or ())
-        return cursor.fetchall()
+        with self.pool.connection() as db:
+            cursor = db.cursor(dictionary=True)
+            cursor.execute(query, params or ())
+            results = cursor.fetchall()
+            cursor.close()
+        return results
 
     def notify(self, topic, payload):
-        message_json = json.loads(payload)
+        # JSON or binary, depending on the format advertised by the device
+        message_json = decode_measurement(payload)
         topic_parts = topic.split("/")
         building = topic_parts[0]
         floor = topic_parts[1]
@@ -58,14 +179,113 @@ class TimeSeriesAdaptor:
         timestamp = datetime.fromtimestamp(message_json["timestamp"])
         value = message_json["value"]
 
-        if(measureType in ["aqi", "windows", "ventilation"]):
-            tables = {"aqi": "air_quality_index", "windows": "windows", "ventilation": "ventilation"}
-            query = f"INSERT INTO {tables[measureType]} (building, floor, room, value, timestamp) VALUES (%s, %s, %s, %s, %s)"
-            self._fetch_results(query, (building, floor, room, value, timestamp))
+        if(measureType in TABLES):
+            self.writer.submit(TABLES[measureType], (building, floor, room, value, timestamp))
 
 
     def stopMqttClient(self):
+        self.watchStop.set()
         self.mqttClient.stop()
+        # Write whatever is still buffered before exiting
+        self.writer.stop()
+        self.rollups.stop()
+        self.pool.close()
+
+    @staticmethod
+    def _where(room, time_interval, time_column):
+        """Build the WHERE clause filtering on room and on the last `time_interval`."""
+        where = "1=1"
+        where_params = []
+        if room:
+            where += " AND room = %s"
+            where_params.append(room)
+        if time_interval:
+            value, unit = time_interval
+            where += f" AND {time_column} >= NOW() - INTERVAL %s {unit}"
+            where_params.append(value)
+        return where, where_params
+
+    def _aggregate(self, table, bucket, agg, room, time_interval):
+        """Group the rows into buckets of `bucket` seconds and aggregate each bucket in SQL."""
+        # Read from the coarsest rollup table able to answer, raw rows otherwise
+        tier = self.rollups.tier_for(table, bucket, agg)
+        if tier:
+            where, where_params = self._where(room, time_interval, "bucket")
+            query = (
+                f"SELECT room, FLOOR(UNIX_TIMESTAMP(bucket) / %s) * %s AS bucket, {ROLLUP_AGGREGATES[agg]} AS value "
+                f"FROM {tier} WHERE {where} GROUP BY room, 2 ORDER BY room, 2"
+            )
+            query_params = [bucket, bucket] + where_params
+            return self._columnar(self._fetch_results(query, query_params), bucket, agg)
+
+        where, where_params = self._where(room, time_interval, "timestamp")
+        bucket_expr = "FLOOR(UNIX_TIMESTAMP(timestamp) / %s) * %s"
+        if agg == "p95":
+            # Nearest-rank 95th percentile: smallest value whose percent rank is >= 0.95
+            query = (
+                f"SELECT room, bucket, MIN(value) AS value FROM ("
+                f"SELECT room, {bucket_expr} AS bucket, value, "
+                f"PERCENT_RANK() OVER (PARTITION BY room, {bucket_expr} ORDER BY value) AS pr "
+                f"FROM {table} WHERE {where}"
+                f") ranked WHERE pr >= 0.95 GROUP BY room, bucket ORDER BY room, bucket"
+            )
+            query_params = [bucket, bucket, bucket, bucket] + where_params
+        else:
+            query = (
+                f"SELECT room, {bucket_expr} AS bucket, {AGGREGATES[agg]} AS value "
+                f"FROM {table} WHERE {where} GROUP BY room, bucket ORDER BY room, bucket"
+            )
+            query_params = [bucket, bucket] + where_params
+
+        return self._columnar(self._fetch_results(query, query_params), bucket, agg)
+
+    @staticmethod
+    def _columnar(results, bucket, agg):
+        # Columnar output keeps the payload small for long series
+        return {
+            "bucketSeconds": bucket,
+            "agg": agg,
+            "room": [row["room"] for row in results],
+            "timestamp": [int(row["bucket"]) for row in results],
+            "value": [float(row["value"]) if row["value"] is not None else None for row in results]
+        }
+
+    def _stream_results(self, query, params, fmt):
+        """Run a query and return a generator of its rows, chunk by chunk, encoded as NDJSON or CSV.
+
+        The connection is checked out and the query executed before the response
+        starts, so that a busy pool or a SQL error still gets its own status.
+        """
+        with ExitStack() as stack:
+            db = stack.enter_context(self.pool.connection())
+            # Unbuffered cursor: rows are read from the server as they are fetched
+            cursor = db.cursor(dictionary=True, buffered=False)
+            cursor.execute(query, params)
+            # The generator now owns the connection
+            stack = stack.pop_all()
+        return self._stream_rows(stack, cursor, fmt)
+
+    @staticmethod
+    def _stream_rows(stack, cursor, fmt):
+        with stack:
+            columns = list(cursor.column_names)
+            if fmt == "csv":
+                buffer = io.StringIO()
+                writer = csv.DictWriter(buffer, fieldnames=columns)
+                writer.writeheader()
+                yield buffer.getvalue().encode('utf-8')
+            while True:
+                rows = cursor.fetchmany(STREAM_CHUNK_ROWS)
+                if not rows:
+                    break
+                if fmt == "csv":
+                    buffer = io.StringIO()
+                    writer = csv.DictWriter(buffer, fieldnames=columns)
+                    writer.writerows(rows)
+                    yield buffer.getvalue().encode('utf-8')
+                else:
+                    yield "".join(json.dumps(row, default=str) + "\n" for row in rows).encode('utf-8')
+            cursor.close()
 
     def GET(self, *uri, **params):
         """Handle GET requests."""
@@ -73,32 +293,76 @@ class TimeSeriesAdaptor:
             return json.dumps({"error": "Invalid endpoint"}).encode('utf-8')
 
         endpoint = uri[0]
-        if endpoint not in ["aqi", "windows", "ventilation"]:
+        if endpoint == "stats":
+            return json.dumps({
+                "ingestion": self.writer.stats(),
+                "pool": self.pool.stats(),
+                "rollups": self.rollups.stats
+            }).encode('utf-8')
+
+        if endpoint not in TABLES:
             return json.dumps({"error": "Invalid endpoint"}).encode('utf-8')
 
         room = params.get("room")
         time_range = params.get("range")  # '1h', '30m', '1d', '1y'
+        bucket = params.get("bucket")  # '5m', '1h', '1d'
+        agg = params.get("agg", "avg")
+        fmt = params.get("format", "json")  # 'json', 'ndjson', 'csv'
+        after_id = params.get("after_id")
+        limit = params.get("limit")
 
-        query = f"SELECT * FROM {endpoint} WHERE 1=1"
-        query_params = []
-
-        if room:
-            query += " AND room = %s"
-            query_params.append(room)
-
+        time_interval = None
         if time_range:
-            time_units = {"m": "MINUTE", "h": "HOUR", "d": "DAY", "y": "YEAR"}
-            unit = time_units.get(time_range[-1])  # 'h', 'm', 'y'
+            unit = TIME_UNITS.get(time_range[-1])  # 'h', 'm', 'y'
 
             if unit:
-                value = int(time_range[:-1])
-                query += f" AND timestamp >= NOW() - INTERVAL %s {unit}"
-                query_params.append(value)
+                time_interval = (int(time_range[:-1]), unit)
             else:
                 return json.dumps({"error": "Invalid time range unit"}).encode('utf-8')
 
-        results = self._fetch_results(query, query_params)
-        return json.dumps(results).encode('utf-8')
+        if bucket:
+            if bucket[-1] not in BUCKET_SECONDS or not bucket[:-1].isdigit() or int(bucket[:-1]) == 0:
+                return json.dumps({"error": "Invalid bucket"}).encode('utf-8')
+            if agg not in AGGREGATES and agg != "p95":
+                return json.dumps({"error": "Invalid aggregation"}).encode('utf-8')
+            bucket_seconds = int(bucket[:-1]) * BUCKET_SECONDS[bucket[-1]]
+            try:
+                results = self._aggregate(TABLES[endpoint], bucket_seconds, agg, room, time_interval)
+            except TimeoutError as e:
+                raise cherrypy.HTTPError(503, str(e))
+            return json.dumps(results).encode('utf-8')
+
+        query, query_params = self._where(room, time_interval, "timestamp")
+
+        # Keyset pagination: continue after the last id of the previous page
+        if after_id:
+            if not after_id.isdigit():
+                return json.dumps({"error": "Invalid after_id"}).encode('utf-8')
+            query += " AND id > %s"
+            query_params.append(int(after_id))
+        query = f"SELECT * FROM {TABLES[endpoint]} WHERE {query} ORDER BY id"
+        if limit:
+            if not limit.isdigit():
+                return json.dumps({"error": "Invalid limit"}).encode('utf-8')
+            query += " LIMIT %s"
+            query_params.append(int(limit))
+
+        if fmt in STREAM_TYPES:
+            try:
+                stream = self._stream_results(query, query_params, fmt)
+            except TimeoutError as e:
+                raise cherrypy.HTTPError(503, str(e))
+            cherrypy.response.headers["Content-Type"] = STREAM_TYPES[fmt]
+            cherrypy.response.stream = True
+            return stream
+        if fmt != "json":
+            return json.dumps({"error": "Invalid format"}).encode('utf-8')
+
+        try:
+            results = self._fetch_results(query, query_params)
+        except TimeoutError as e:
+            raise cherrypy.HTTPError(503, str(e))
+        return json.dumps(results, default=str).encode('utf-8')
 
 if __name__ == '__main__':
     conf = {
@@ -0,0 +1,111 @@
+import queue
+import threading
+import time
+
+
+class BatchWriter:
+    """Buffer rows coming from the MQTT thread and write them in multi-row batches."""
+
+    def __init__(self, pool, batchSize=500, flushInterval=0.2, queueSize=10000, enqueueTimeout=0.05):
+        self.pool = pool
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.enqueueTimeout = enqueueTimeout
+        self._queue = queue.Queue(maxsize=queueSize)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+        self._lock = threading.Lock()
+        self._stats = {
+            "enqueued": 0,
+            "written": 0,
+            "dropped": 0,
+            "failed": 0,
+            "blockedEnqueues": 0,
+            "maxQueueDepth": 0,
+            "batches": 0,
+            "lastBatchSize": 0,
+            "lastFlushSeconds": 0.0
+        }
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, table, row):
+        """Queue a row for the given table, blocking briefly when the queue is full."""
+        try:
+            self._queue.put_nowait((table, row))
+        except queue.Full:
+            with self._lock:
+                self._stats["blockedEnqueues"] += 1
+            try:
+                # Hold the network thread for a moment so the broker slows down
+                self._queue.put((table, row), timeout=self.enqueueTimeout)
+            except queue.Full:
+                with self._lock:
+                    self._stats["dropped"] += 1
+                return False
+        with self._lock:
+            self._stats["enqueued"] += 1
+            self._stats["maxQueueDepth"] = max(self._stats["maxQueueDepth"], self._queue.qsize())
+        return True
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["queueDepth"] = self._queue.qsize()
+        stats["queueCapacity"] = self._queue.maxsize
+        return stats
+
+    def stop(self):
+        """Stop the writer thread after flushing everything still queued."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        pending = {}
+        count = 0
+        deadline = None
+        while not (self._stop.is_set() and self._queue.empty()):
+            timeout = self.flushInterval if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                table, row = self._queue.get(timeout=timeout)
+                pending.setdefault(table, []).append(row)
+                count += 1
+                if deadline is None:
+                    deadline = time.monotonic() + self.flushInterval
+            except queue.Empty:
+                pass
+
+            if count and (count >= self.batchSize or time.monotonic() >= deadline):
+                self._flush(pending, count)
+                pending = {}
+                count = 0
+                deadline = None
+
+        if count:
+            self._flush(pending, count)
+
+    def _flush(self, pending, count):
+        start = time.monotonic()
+        written = 0
+        for table, rows in pending.items():
+            query = f"INSERT INTO {table} (building, floor, room, value, timestamp) VALUES (%s, %s, %s, %s, %s)"
+            try:
+                with self.pool.connection() as db:
+                    cursor = db.cursor()
+                    cursor.executemany(query, rows)
+                    db.commit()
+                    cursor.close()
+                written += len(rows)
+            except Exception as e:
+                print(f"Error writing {len(rows)} rows to {table}: {e}")
+                with self._lock:
+                    self._stats["failed"] += len(rows)
+
+        with self._lock:
+            self._stats["written"] += written
+            self._stats["batches"] += 1
+            self._stats["lastBatchSize"] = count
+            self._stats["lastFlushSeconds"] = time.monotonic() - start
@@ -0,0 +1,121 @@
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+
+class ConnectionPool:
+    """Fixed-size pool of database connections shared by the REST and MQTT threads."""
+
+    def __init__(self, connect, size=5, timeout=5):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        # Slots start empty, connections are opened the first time they are needed
+        self._idle = queue.LifoQueue(maxsize=size)
+        for _ in range(size):
+            self._idle.put(None)
+
+        self._lock = threading.Lock()
+        self._stats = {
+            "inUse": 0,
+            "maxInUse": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "totalWaitSeconds": 0.0,
+            "opened": 0,
+            "reconnects": 0,
+            "errors": 0
+        }
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of a with block."""
+        db = self._checkout()
+        try:
+            yield db
+        except BaseException:
+            # Also covers GeneratorExit when a streamed response is abandoned midway
+            with self._lock:
+                self._stats["errors"] += 1
+            # The connection may be in an unknown state, replace it on the next checkout
+            self._discard(db)
+            db = None
+            raise
+        finally:
+            self._checkin(db)
+
+    def _checkout(self):
+        start = time.monotonic()
+        try:
+            db = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                self._stats["waits"] += 1
+            try:
+                db = self._idle.get(timeout=self.timeout)
+            except queue.Empty:
+                with self._lock:
+                    self._stats["timeouts"] += 1
+                raise TimeoutError(f"No database connection available after {self.timeout} s")
+
+        try:
+            if db is None:
+                db = self.connect()
+                with self._lock:
+                    self._stats["opened"] += 1
+            elif not db.is_connected():
+                self._discard(db)
+                db = self.connect()
+                with self._lock:
+                    self._stats["reconnects"] += 1
+        except Exception:
+            # Give the slot back so a failed connect does not shrink the pool
+            self._idle.put(None)
+            raise
+
+        with self._lock:
+            self._stats["checkouts"] += 1
+            self._stats["totalWaitSeconds"] += time.monotonic() - start
+            self._stats["inUse"] += 1
+            self._stats["maxInUse"] = max(self._stats["maxInUse"], self._stats["inUse"])
+        return db
+
+    def _checkin(self, db):
+        if db is not None:
+            try:
+                # End the transaction a read left open, otherwise the next user of the
+                # connection keeps seeing its snapshot and it holds metadata locks
+                db.rollback()
+            except Exception:
+                self._discard(db)
+                db = None
+        with self._lock:
+            self._stats["inUse"] -= 1
+        self._idle.put(db)
+
+    @staticmethod
+    def _discard(db):
+        try:
+            db.close()
+        except Exception:
+            pass
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["size"] = self.size
+        stats["idle"] = self.size - stats["inUse"]
+        stats["utilization"] = stats["inUse"] / self.size if self.size else 0.0
+        return stats
+
+    def close(self):
+        """Close every idle connection."""
+        while True:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if db is not None:
+                self._discard(db)
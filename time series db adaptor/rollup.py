@@ -0,0 +1,179 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Rollup tiers of air_quality_index: (name, bucket seconds, source table)
+TIERS = [
+    ("1m", 60, "air_quality_index"),
+    ("1h", 3600, "air_quality_index_1m"),
+    ("1d", 86400, "air_quality_index_1h")
+]
+
+# How each aggregation is computed from a rollup table
+ROLLUP_AGGREGATES = {
+    "avg": "SUM(sum_value) / SUM(count)",
+    "min": "MIN(min_value)",
+    "max": "MAX(max_value)",
+    "count": "SUM(count)"
+}
+
+
+def bucket_start(timestamp, seconds):
+    """Start of the bucket containing an epoch timestamp, aligned like FLOOR(UNIX_TIMESTAMP(x) / s) * s in SQL."""
+    return datetime.fromtimestamp(int(timestamp // seconds) * seconds)
+
+
+class RollupManager:
+    """Background job keeping the rollup tables up to date and enforcing data retention."""
+
+    def __init__(self, pool, rawTables, interval=60, grace=120, partitionDaysAhead=3, retentionDays=None):
+        self.pool = pool
+        self.rawTables = rawTables
+        self.interval = interval
+        self.grace = grace
+        self.partitionDaysAhead = partitionDaysAhead
+        # Days of data to keep per tier, None keeps everything
+        self.retentionDays = retentionDays or {"raw": 30, "1m": 90, "1h": 730, "1d": None}
+        self._watermarks = {}  # tier -> first bucket to recompute on the next run
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.stats = {"runs": 0, "errors": 0, "lastRun": None, "lastRunSeconds": 0.0, "droppedPartitions": 0}
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def tier_for(self, table, bucket_seconds, agg):
+        """Return the coarsest rollup table that can answer a bucketed query, or None for raw data."""
+        if table != "air_quality_index" or agg not in ROLLUP_AGGREGATES:
+            return None
+        for name, seconds, source in reversed(TIERS):
+            if bucket_seconds % seconds == 0:
+                return f"air_quality_index_{name}"
+        return None
+
+    def _run(self):
+        while not self._stop.is_set():
+            start = time.monotonic()
+            try:
+                self.run_once()
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"Error running rollups: {e}")
+            self.stats["runs"] += 1
+            self.stats["lastRun"] = time.time()
+            self.stats["lastRunSeconds"] = time.monotonic() - start
+            self._stop.wait(self.interval)
+
+    def run_once(self):
+        with self.pool.connection() as db:
+            cursor = db.cursor()
+            self._rollup(cursor, time.time())
+            self._maintain_partitions(cursor, datetime.now().date())
+            self._apply_retention(cursor, datetime.now())
+            db.commit()
+            cursor.close()
+
+    def _rollup(self, cursor, now):
+        for name, seconds, source in TIERS:
+            start = self._watermarks.get(name)
+            if start is None:
+                start = self._initial_watermark(cursor, name, seconds, source)
+            # The current, still incomplete bucket is included and recomputed on the next run
+            end = bucket_start(now, seconds) + timedelta(seconds=seconds)
+            if source in self.rawTables:
+                query = (
+                    f"INSERT INTO air_quality_index_{name} (building, floor, room, bucket, sum_value, min_value, max_value, count) "
+                    f"SELECT building, floor, room, FROM_UNIXTIME(FLOOR(UNIX_TIMESTAMP(timestamp) / %s) * %s) AS b, "
+                    f"SUM(value), MIN(value), MAX(value), COUNT(*) FROM {source} "
+                    f"WHERE timestamp >= %s AND timestamp < %s AND value IS NOT NULL "
+                    f"AND building IS NOT NULL AND floor IS NOT NULL AND room IS NOT NULL "
+                    f"GROUP BY building, floor, room, b"
+                )
+            else:
+                query = (
+                    f"INSERT INTO air_quality_index_{name} (building, floor, room, bucket, sum_value, min_value, max_value, count) "
+                    f"SELECT building, floor, room, FROM_UNIXTIME(FLOOR(UNIX_TIMESTAMP(bucket) / %s) * %s) AS b, "
+                    f"SUM(sum_value), MIN(min_value), MAX(max_value), SUM(count) FROM {source} "
+                    f"WHERE bucket >= %s AND bucket < %s GROUP BY building, floor, room, b"
+                )
+            query += (
+                " ON DUPLICATE KEY UPDATE sum_value = VALUES(sum_value), min_value = VALUES(min_value), "
+                "max_value = VALUES(max_value), count = VALUES(count)"
+            )
+            cursor.execute(query, (seconds, seconds, start, end))
+            # Rows can arrive late, so the last `grace` seconds are recomputed next time
+            self._watermarks[name] = min(bucket_start(now - self.grace, seconds), end)
+
+    def _initial_watermark(self, cursor, name, seconds, source):
+        """Resume from the last bucket already rolled up, or from the oldest source row."""
+        cursor.execute(f"SELECT MAX(bucket) FROM air_quality_index_{name}")
+        (last,) = cursor.fetchone()
+        if last is None:
+            column = "timestamp" if source in self.rawTables else "bucket"
+            cursor.execute(f"SELECT MIN({column}) FROM {source}")
+            (last,) = cursor.fetchone()
+        if last is None:
+            return bucket_start(time.time(), seconds)
+        return bucket_start(last.timestamp(), seconds)
+
+    def _maintain_partitions(self, cursor, today):
+        """Create the daily partitions of the coming days and drop the expired ones."""
+        keep_days = self.retentionDays.get("raw")
+        for table in self.rawTables:
+            cursor.execute(
+                "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL",
+                (table,)
+            )
+            names = [row[0] for row in cursor.fetchall()]
+            if "p_future" not in names:
+                # Table created without partitions
+                continue
+            days = sorted(datetime.strptime(n[1:], "%Y%m%d").date() for n in names if n[1:].isdigit())
+
+            if days:
+                first_new = max(days[-1] + timedelta(days=1), today)
+            else:
+                # First run on a table holding history: start from its oldest day, so
+                # that the existing rows are split by day and expire day by day too.
+                # Rows beyond the raw retention all go to the first partition, dropped below.
+                cursor.execute(f"SELECT MIN(timestamp) FROM {table}")
+                (oldest,) = cursor.fetchone()
+                first_new = today if oldest is None else min(oldest.date(), today)
+                if keep_days is not None:
+                    first_new = max(first_new, today - timedelta(days=keep_days + 1))
+            new_days = []
+            day = first_new
+            while day <= today + timedelta(days=self.partitionDaysAhead):
+                new_days.append(day)
+                day += timedelta(days=1)
+            if new_days:
+                # Each partition p<day> holds the rows before the end of that day
+                partitions = ", ".join(
+                    f"PARTITION p{d:%Y%m%d} VALUES LESS THAN (TO_DAYS('{d + timedelta(days=1)}'))" for d in new_days
+                )
+                cursor.execute(
+                    f"ALTER TABLE {table} REORGANIZE PARTITION p_future INTO "
+                    f"({partitions}, PARTITION p_future VALUES LESS THAN MAXVALUE)"
+                )
+
+            if keep_days is not None:
+                cutoff = today - timedelta(days=keep_days)
+                expired = [f"p{d:%Y%m%d}" for d in days if d < cutoff]
+                if expired:
+                    cursor.execute(f"ALTER TABLE {table} DROP PARTITION {', '.join(expired)}")
+                    self.stats["droppedPartitions"] += len(expired)
+
+    def _apply_retention(self, cursor, now):
+        for name, seconds, source in TIERS:
+            keep_days = self.retentionDays.get(name)
+            if keep_days is not None:
+                cursor.execute(
+                    f"DELETE FROM air_quality_index_{name} WHERE bucket < %s",
+                    (now - timedelta(days=keep_days),)
+                )
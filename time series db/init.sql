@@ -2,27 +2,86 @@ CREATE DATABASE IF NOT EXISTS timeseries_db;
 
 USE timeseries_db;
 
+-- Raw tables are partitioned by day so that old data can be dropped a partition at a time.
+-- The adaptor's rollup job adds the daily partitions ahead of time by splitting p_future.
 CREATE TABLE IF NOT EXISTS air_quality_index (
-    id INT PRIMARY KEY AUTO_INCREMENT,
-    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+    id INT AUTO_INCREMENT,
+    timestamp DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     building VARCHAR(50),
     floor INT,
     room VARCHAR(50),
-    aqi FLOAT
+    value FLOAT,
+    PRIMARY KEY (id, timestamp),
+    INDEX idx_room_timestamp (room, timestamp)
+)
+PARTITION BY RANGE (TO_DAYS(timestamp)) (
+    PARTITION p_start VALUES LESS THAN (0),
+    PARTITION p_future VALUES LESS THAN MAXVALUE
 );
 CREATE TABLE IF NOT EXISTS windows (
-    id INT PRIMARY KEY AUTO_INCREMENT,
-    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+    id INT AUTO_INCREMENT,
+    timestamp DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     building VARCHAR(50),
     floor INT,
     room VARCHAR(50),
-    state VARCHAR(50)
+    value VARCHAR(50),
+    PRIMARY KEY (id, timestamp),
+    INDEX idx_room_timestamp (room, timestamp)
+)
+PARTITION BY RANGE (TO_DAYS(timestamp)) (
+    PARTITION p_start VALUES LESS THAN (0),
+    PARTITION p_future VALUES LESS THAN MAXVALUE
 );
 CREATE TABLE IF NOT EXISTS ventilation (
-    id INT PRIMARY KEY AUTO_INCREMENT,
-    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+    id INT AUTO_INCREMENT,
+    timestamp DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     building VARCHAR(50),
     floor INT,
     room VARCHAR(50),
-    state VARCHAR(50)
-);
\ No newline at end of file
+    value VARCHAR(50),
+    PRIMARY KEY (id, timestamp),
+    INDEX idx_room_timestamp (room, timestamp)
+)
+PARTITION BY RANGE (TO_DAYS(timestamp)) (
+    PARTITION p_start VALUES LESS THAN (0),
+    PARTITION p_future VALUES LESS THAN MAXVALUE
+);
+
+-- Rollups of air_quality_index per minute, hour and day, maintained by the adaptor.
+-- Sums and counts are stored instead of averages so coarser tiers can be built from finer ones.
+CREATE TABLE IF NOT EXISTS air_quality_index_1m (
+    building VARCHAR(50) NOT NULL,
+    floor INT NOT NULL,
+    room VARCHAR(50) NOT NULL,
+    bucket DATETIME NOT NULL,
+    sum_value DOUBLE,
+    min_value FLOAT,
+    max_value FLOAT,
+    count INT,
+    PRIMARY KEY (building, floor, room, bucket),
+    INDEX idx_room_bucket (room, bucket)
+);
+CREATE TABLE IF NOT EXISTS air_quality_index_1h (
+    building VARCHAR(50) NOT NULL,
+    floor INT NOT NULL,
+    room VARCHAR(50) NOT NULL,
+    bucket DATETIME NOT NULL,
+    sum_value DOUBLE,
+    min_value FLOAT,
+    max_value FLOAT,
+    count INT,
+    PRIMARY KEY (building, floor, room, bucket),
+    INDEX idx_room_bucket (room, bucket)
+);
+CREATE TABLE IF NOT EXISTS air_quality_index_1d (
+    building VARCHAR(50) NOT NULL,
+    floor INT NOT NULL,
+    room VARCHAR(50) NOT NULL,
+    bucket DATETIME NOT NULL,
+    sum_value DOUBLE,
+    min_value FLOAT,
+    max_value FLOAT,
+    count INT,
+    PRIMARY KEY (building, floor, room, bucket),
+    INDEX idx_room_bucket (room, bucket)
+);
@@ -1,16 +1,35 @@
 import telepot
 from telepot.loop import MessageLoop
 from telepot.namedtuple import ReplyKeyboardMarkup, KeyboardButton
+import datetime
+import io
 import json
+import queue
+import threading
 import time
-import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
+from charts import ChartCache, data_version, render_daily_graph
 
 
 class AirQualityBot:
-    def __init__(self, token):
+    def __init__(self, token, workers=4, render_workers=2, max_pending_renders=20):
         self.tokenBot = token
         self.bot = telepot.Bot(self.tokenBot)
         self.user_data = {}  # Dictionary to store user data (chat_id -> {rooms, name})
+        # Where each chat is in its conversation: chat_id -> (step, rooms selected so far)
+        self.conversations = {}
+
+        # MessageLoop only queues the messages. Each chat always goes to the same
+        # worker so that its messages are handled in order, other chats go on in parallel
+        self._queues = [queue.Queue(maxsize=100) for _ in range(workers)]
+        for messages in self._queues:
+            threading.Thread(target=self._work, args=(messages,), daemon=True).start()
+        # Charts are rendered and uploaded on their own pool, so that a slow chart
+        # does not hold up the chat worker either. Requests beyond the limit are refused
+        self._renderer = ThreadPoolExecutor(max_workers=render_workers)
+        self._render_slots = threading.BoundedSemaphore(max_pending_renders)
+        # Rendered PNGs, kept in memory by (room, day, data version)
+        self.charts = ChartCache()
 
         self.initialize_bot()
 
@@ -25,6 +44,22 @@ class AirQualityBot:
                 time.sleep(5)
 
     def on_chat_message(self, msg):
+        """Queue a message for the worker of its chat."""
+        chat_id = msg['chat']['id']
+        try:
+            self._queues[hash(chat_id) % len(self._queues)].put_nowait(msg)
+        except queue.Full:
+            print(f"Dropped a message from chat {chat_id}, the workers are overloaded")
+
+    def _work(self, messages):
+        while True:
+            msg = messages.get()
+            try:
+                self.handle_message(msg)
+            except Exception as e:
+                print(f"Error handling message: {e}")
+
+    def handle_message(self, msg):
         content_type, chat_type, chat_id = telepot.glance(msg)
         user_name = msg['from'].get('first_name', 'User')  # Get user's first name from Telegram
 
@@ -44,25 +79,25 @@ class AirQualityBot:
                     self.bot.sendMessage(chat_id, f"{user_name}, you are already registered.\n"
                                                 "Would you like to update your list of rooms?\n"
                                                 "Please provide your rooms in the format:\n<room1> <room2> ...")
-                    self.bot_listener = ("update_rooms", chat_id)
+                    self.conversations[chat_id] = ("update_rooms", None)
                 else:
                     self.bot.sendMessage(chat_id, f"{user_name}, you need to register first.\n"
                                                 "Please provide your details in the format:\n<room1> <room2> ...")
-                    self.bot_listener = ("register", chat_id)
+                    self.conversations[chat_id] = ("register", None)
             elif message == "/control":
                 if chat_id in self.user_data:
                     self.bot.sendMessage(chat_id, "Please specify the room(s) for the action (e.g., '1 2 3' or 'all').")
-                    self.bot_listener = ("control_select_room", chat_id)
+                    self.conversations[chat_id] = ("control_select_room", None)
                 else:
                     self.bot.sendMessage(chat_id, "You need to register first. Use /user_management to register.")
             elif message == "/status":
                 if chat_id in self.user_data:
                     self.bot.sendMessage(chat_id, "Please specify the room(s) for the status (e.g., '1 2 3' or 'all').")
-                    self.bot_listener = ("status_select_room", chat_id)
+                    self.conversations[chat_id] = ("status_select_room", None)
                 else:
                     self.bot.sendMessage(chat_id, "You need to register first. Use /user_management to register.")
-            elif hasattr(self, "bot_listener") and self.bot_listener[1] == chat_id:
-                command = self.bot_listener[0]
+            elif chat_id in self.conversations:
+                command, rooms = self.conversations[chat_id]
                 if command == "register":
                     self.handle_registration(chat_id, message, user_name)
                 elif command == "update_rooms":
@@ -70,13 +105,13 @@ class AirQualityBot:
                 elif command == "control_select_room":
                     self.validate_rooms(chat_id, message)
                 elif command == "control_select_action":
-                    self.handle_control_action(chat_id, message)
-                    del self.bot_listener  # Only clear listener after processing the action
+                    self.handle_control_action(chat_id, message, rooms)
+                    del self.conversations[chat_id]  # Only clear the conversation after processing the action
                 elif command == "status_select_room":
                     self.validate_status_rooms(chat_id, message)
                 elif command == "status_select_type":
-                    self.handle_status_type(chat_id, message)
-                    del self.bot_listener  # Only clear listener after processing the status
+                    self.handle_status_type(chat_id, message, rooms)
+                    del self.conversations[chat_id]  # Only clear the conversation after processing the status
             else:
                 self.bot.sendMessage(chat_id, "Unknown command. Use /start for available commands.")
 
@@ -94,8 +129,8 @@ class AirQualityBot:
                 self.bot.sendMessage(chat_id, f"Please select one of your registered rooms. Invalid rooms: {', '.join(map(str, invalid_rooms))}")
                 return
 
-            # Store validated rooms in listener
-            self.bot_listener = ("control_select_action", chat_id, rooms)
+            # Keep the validated rooms for the next step of the conversation
+            self.conversations[chat_id] = ("control_select_action", rooms)
 
             keyboard = ReplyKeyboardMarkup(
                 keyboard=[
@@ -109,9 +144,8 @@ class AirQualityBot:
         except Exception as e:
             self.bot.sendMessage(chat_id, f"Error validating rooms. Ensure your input is correct.\nError: {e}")
 
-    def handle_control_action(self, chat_id, action):
+    def handle_control_action(self, chat_id, action, rooms):
         if action in ["open_window", "close_window", "activate_ventilation", "stop_ventilation"]:
-            rooms = self.bot_listener[2]  # Retrieve validated rooms
             self.handle_control_room(chat_id, rooms, action)
         else:
             self.bot.sendMessage(chat_id, "Invalid action. Please choose one of the options provided.")
@@ -172,8 +206,8 @@ class AirQualityBot:
                 self.bot.sendMessage(chat_id, f"Please select one of your registered rooms. Invalid rooms: {', '.join(map(str, invalid_rooms))}")
                 return
 
-            # Store validated rooms in listener
-            self.bot_listener = ("status_select_type", chat_id, rooms)
+            # Keep the validated rooms for the next step of the conversation
+            self.conversations[chat_id] = ("status_select_type", rooms)
 
             # Display status options using a nice keyboard
             keyboard = ReplyKeyboardMarkup(
@@ -187,9 +221,8 @@ class AirQualityBot:
         except Exception as e:
             self.bot.sendMessage(chat_id, f"Error validating rooms. Ensure your input is correct.\nError: {e}")
 
-    def handle_status_type(self, chat_id, status_type):
+    def handle_status_type(self, chat_id, status_type, rooms):
         if status_type in ["present_status", "daily_status"]:
-            rooms = self.bot_listener[2]  # Retrieve validated rooms
             self.handle_status_room(chat_id, rooms, status_type)
         else:
             self.bot.sendMessage(chat_id, "Invalid status type. Please choose one of the options provided.")
@@ -235,7 +268,7 @@ class AirQualityBot:
                         try:
                             with open("daily_status.json", "r") as file:
                                 daily_data = json.load(file)
-                            self.generate_daily_graph(chat_id, room, daily_data)
+                            self.submit_daily_graph(chat_id, room, daily_data)
                         except FileNotFoundError:
                             self.bot.sendMessage(chat_id, "Error: Daily statistics file not found.")
                         except json.JSONDecodeError:
@@ -246,61 +279,38 @@ class AirQualityBot:
             self.bot.sendMessage(chat_id, f"Error fetching status for rooms {rooms}. Ensure room selection is correct.\nError: {e}")
 
 
-    def generate_daily_graph(self, chat_id, room, daily_data):
-        try:
-            hours = [data["hour"] for data in daily_data]
-            air_quality = [data["air_quality"] for data in daily_data]
-
-            plt.figure(figsize=(10, 6))
-            plt.plot(hours, air_quality, marker="o", linestyle="-", label=f"Room {room}")
-            plt.title(f"Daily Air Quality for Room {room}", fontsize=16)
-            plt.xlabel("Hour of the Day", fontsize=12)
-            plt.ylabel("Air Quality (1=Very Good, 5=Very Poor)", fontsize=12)
-            plt.xticks(hours)
-            plt.grid(True)
-            plt.legend()
-
-            file_name = f"daily_air_quality_room_{room}_{chat_id}.png"
-            plt.savefig(file_name)
-            plt.close()
-
-            with open(file_name, "rb") as photo:
-                self.bot.sendPhoto(chat_id, photo)
-        except Exception as e:
-            self.bot.sendMessage(chat_id, f"Error plotting daily graph for Room {room}: {e}")
+    def submit_daily_graph(self, chat_id, room, daily_data):
+        """Render and send a daily graph in the background."""
+        if not self._render_slots.acquire(blocking=False):
+            self.bot.sendMessage(chat_id, f"Too many graphs are being prepared, please ask for Room {room} again in a moment.")
+            return
 
+        def render():
+            try:
+                self.generate_daily_graph(chat_id, room, daily_data)
+            finally:
+                self._render_slots.release()
+
+        self._renderer.submit(render)
 
-    def plot_daily_graph(self, chat_id, daily_data, room):
+    def generate_daily_graph(self, chat_id, room, daily_data):
         try:
-            hours = [data["hour"] for data in daily_data]
-            air_quality = [data["air_quality"] for data in daily_data]
-
-            plt.figure(figsize=(10, 6))
-            plt.plot(hours, air_quality, marker="o", linestyle="-", label=f"Room {room}")
-            plt.title(f"Daily Air Quality for Room {room}", fontsize=16)
-            plt.xlabel("Hour of the Day", fontsize=12)
-            plt.ylabel("Air Quality (1=Very Good, 5=Very Poor)", fontsize=12)
-            plt.xticks(hours)
-            plt.grid(True)
-            plt.legend()
-
-            file_name = f"daily_air_quality_room_{room}_{chat_id}.png"
-            plt.savefig(file_name)
-            plt.close()
-
-            with open(file_name, "rb") as photo:
-                self.bot.sendPhoto(chat_id, photo)
+            # Everyone asking for the same room and data on the same day shares one render
+            key = (room, datetime.date.today().isoformat(), data_version(daily_data))
+            png = self.charts.get(key, lambda: render_daily_graph(room, daily_data))
+            self.bot.sendPhoto(chat_id, (f"daily_air_quality_room_{room}.png", io.BytesIO(png)))
         except Exception as e:
             self.bot.sendMessage(chat_id, f"Error plotting daily graph for Room {room}: {e}")
 
 
-# Load bot token from JSON file
-#with open("bot_token.json", "r") as file:
-    #data = json.load(file)
+if __name__ == "__main__":
+    # Load bot token from JSON file
+    #with open("bot_token.json", "r") as file:
+        #data = json.load(file)
 
-# Initialize bot
-bot_instance = AirQualityBot("7847206958:AAGvH3qIjyyLmkfG4o0HjrDpNsh6WAi0LfM")
+    # Initialize bot
+    bot_instance = AirQualityBot("7847206958:AAGvH3qIjyyLmkfG4o0HjrDpNsh6WAi0LfM")
 
-# Keep bot alive
-while True:
-    time.sleep(10)
+    # Keep bot alive
+    while True:
+        time.sleep(10)
@@ -0,0 +1,78 @@
+import hashlib
+import io
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+
+def data_version(data):
+    """Short hash identifying a dataset, so charts of changed data are rendered again."""
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def render_daily_graph(room, daily_data):
+    """Draw the daily air quality of a room and return it as PNG bytes."""
+    hours = [data["hour"] for data in daily_data]
+    air_quality = [data["air_quality"] for data in daily_data]
+
+    # A Figure of its own instead of pyplot's global state, safe to use from several threads
+    figure = Figure(figsize=(10, 6))
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    axes.plot(hours, air_quality, marker="o", linestyle="-", label=f"Room {room}")
+    axes.set_title(f"Daily Air Quality for Room {room}", fontsize=16)
+    axes.set_xlabel("Hour of the Day", fontsize=12)
+    axes.set_ylabel("Air Quality (1=Very Good, 5=Very Poor)", fontsize=12)
+    axes.set_xticks(hours)
+    axes.grid(True)
+    axes.legend()
+
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+
+class ChartCache:
+    """LRU cache of rendered charts.
+
+    Requests for a chart that is being rendered wait for that render instead of
+    starting their own, so many users asking for the same chart cost one render.
+    """
+
+    def __init__(self, capacity=128):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._charts = OrderedDict()  # key -> Future of the PNG bytes
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key, render):
+        """Return the chart for key, calling render() to draw it when it is not cached."""
+        owner = False
+        with self._lock:
+            future = self._charts.get(key)
+            if future is not None:
+                self._charts.move_to_end(key)
+                self.stats["hits"] += 1
+            else:
+                future = self._charts[key] = Future()
+                self.stats["misses"] += 1
+                while len(self._charts) > self.capacity:
+                    self._charts.popitem(last=False)
+                    self.stats["evictions"] += 1
+                owner = True
+        if not owner:
+            return future.result()
+
+        try:
+            future.set_result(render())
+        except Exception as e:
+            # Do not keep the failure, the next request tries again
+            with self._lock:
+                if self._charts.get(key) is future:
+                    del self._charts[key]
+            future.set_exception(e)
+        return future.result()
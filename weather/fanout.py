@@ -0,0 +1,88 @@
+import queue
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class FanOut:
+    """Forward the received weather to the downstream consumers from background threads.
+
+    Every HTTP target and the MQTT client get their own queue and thread, so the
+    ingest request only queues the payload and a slow or unreachable consumer
+    neither delays the others nor the adaptor. When a queue is full the new
+    payload is dropped for that consumer.
+    """
+
+    def __init__(self, targets=(), mqtt_client=None, topic="weather/{building}", queue_size=1000,
+                 retries=3, backoff=0.5, timeout=5):
+        self.topic = topic
+        self.timeout = timeout
+        self.queue_size = queue_size
+        self.mqtt_client = mqtt_client
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._threads = []
+        self.stats = {}
+
+        for target in targets:
+            # Keep-alive connections to the target, retried with exponential backoff
+            session = requests.Session()
+            session.mount(target, HTTPAdapter(max_retries=Retry(
+                total=retries,
+                backoff_factor=backoff,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=None
+            )))
+            self._add_consumer(target, lambda payload, target=target, session=session: self._post(session, target, payload))
+        if mqtt_client is not None:
+            self._add_consumer("mqtt", self._publish)
+
+    def _add_consumer(self, name, send):
+        messages = queue.Queue(maxsize=self.queue_size)
+        self._queues[name] = messages
+        self.stats[name] = {"sent": 0, "failed": 0, "dropped": 0}
+        thread = threading.Thread(target=self._run, args=(name, messages, send), daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def submit(self, payload):
+        """Queue a payload for every consumer without waiting for any of them."""
+        for name, messages in self._queues.items():
+            try:
+                messages.put_nowait(payload)
+            except queue.Full:
+                with self._lock:
+                    self.stats[name]["dropped"] += 1
+
+    def _run(self, name, messages, send):
+        while True:
+            payload = messages.get()
+            if payload is None:
+                break
+            try:
+                send(payload)
+                result = "sent"
+            except Exception as e:
+                print(f"Error sending weather to {name}: {e}")
+                result = "failed"
+            with self._lock:
+                self.stats[name][result] += 1
+
+    def _post(self, session, target, payload):
+        response = session.post(target, json=payload, timeout=self.timeout)
+        response.raise_for_status()
+
+    def _publish(self, payload):
+        # One retained message per building, so new subscribers get the latest weather at once
+        for weather_data in payload:
+            topic = self.topic.format(building=weather_data["building_name"])
+            self.mqtt_client.myPublish(topic, weather_data, retain=True)
+
+    def stop(self):
+        """Send what is still queued, then stop the threads."""
+        for messages in self._queues.values():
+            messages.put(None)
+        for thread in self._threads:
+            thread.join()
@@ -0,0 +1,106 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ForecastCache:
+    """LRU cache of Open-Meteo responses by location.
+
+    Coordinates are rounded to the grid so that nearby buildings share an entry.
+    An entry is fresh for ttl seconds; until stale_ttl it is still served while
+    a background call refreshes it, after that it has to be fetched again.
+    fetch(coordinates) queries the API for a list of (latitude, longitude) and
+    returns one response per coordinate, in order.
+    """
+
+    def __init__(self, fetch, ttl=900, stale_ttl=3600, capacity=256, grid=0.01, on_refresh=None):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.capacity = capacity
+        self.grid = grid
+        # Called with the refreshed keys once a background refresh is stored
+        self.on_refresh = on_refresh
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (fetched at, response)
+        self._refreshing = set()
+        self.stats = {"hits": 0, "staleHits": 0, "misses": 0, "upstreamCalls": 0,
+                      "refreshes": 0, "refreshErrors": 0, "evictions": 0}
+
+    def key(self, latitude, longitude):
+        return (round(round(latitude / self.grid) * self.grid, 6), round(round(longitude / self.grid) * self.grid, 6))
+
+    def get_many(self, coordinates):
+        """Return the responses of the coordinates, in order.
+
+        Missing or expired locations are fetched together in one call; stale ones
+        are returned at once and refreshed in the background.
+        """
+        keys = [self.key(latitude, longitude) for latitude, longitude in coordinates]
+        now = time.monotonic()
+        found, missing, stale = {}, [], []
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                entry = self._entries.get(key)
+                if entry is None or now - entry[0] > self.stale_ttl:
+                    missing.append(key)
+                    self.stats["misses"] += 1
+                    continue
+                self._entries.move_to_end(key)
+                found[key] = entry[1]
+                if now - entry[0] <= self.ttl:
+                    self.stats["hits"] += 1
+                else:
+                    self.stats["staleHits"] += 1
+                    if key not in self._refreshing:
+                        self._refreshing.add(key)
+                        stale.append(key)
+
+        if stale:
+            threading.Thread(target=self._refresh, args=(stale,), daemon=True).start()
+        if missing:
+            found.update(self._fetch(missing))
+        return [found[key] for key in keys]
+
+    def refreshing(self, latitude, longitude):
+        """True while the entry of a location is being refreshed in the background."""
+        with self._lock:
+            return self.key(latitude, longitude) in self._refreshing
+
+    def _fetch(self, keys):
+        with self._lock:
+            self.stats["upstreamCalls"] += 1
+        responses = dict(zip(keys, self.fetch(keys)))
+        fetched_at = time.monotonic()
+        with self._lock:
+            for key, response in responses.items():
+                self._entries[key] = (fetched_at, response)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+        return responses
+
+    def _refresh(self, keys):
+        try:
+            self._fetch(keys)
+            with self._lock:
+                self.stats["refreshes"] += 1
+        except Exception as e:
+            # The stale entries are served until stale_ttl, the next request tries again
+            print(f"Error refreshing the forecast of {len(keys)} locations: {e}")
+            with self._lock:
+                self.stats["refreshErrors"] += 1
+            return
+        finally:
+            with self._lock:
+                self._refreshing.difference_update(keys)
+        if self.on_refresh:
+            self.on_refresh(keys)
+
+    def hit_rate(self, stale=True):
+        """Share of the lookups answered from the cache, counting the stale ones or not."""
+        with self._lock:
+            hits = self.stats["hits"] + (self.stats["staleHits"] if stale else 0)
+            total = self.stats["hits"] + self.stats["staleHits"] + self.stats["misses"]
+        return hits / total if total else 0.0
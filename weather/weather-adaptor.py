@@ -1,10 +1,36 @@
+import os
+import sys
+import requests
 from flask import Flask, jsonify, request
+from fanout import FanOut
+from weather_store import WeatherStore, to_epoch
+# MyMQTT lives in common/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from MyMQTT import MyMQTT
 
 app = Flask(__name__)
 
-received_data = None
+# Weather of every building by hour, persisted in SQLite when WEATHER_DB is set
+store = WeatherStore(
+    max_hours=int(os.environ.get("WEATHER_MAX_HOURS", 24 * 14)),
+    db_path=os.environ.get("WEATHER_DB")
+)
 
-# TARGET_SYSTEM_URL = "http://<target-microservice>:<port>/endpoint"
+
+def connect_mqtt(catalog_url):
+    """MQTT client for the broker registered in the catalog."""
+    broker_info = requests.get(f"{catalog_url}/broker", timeout=10).json()
+    client = MyMQTT("weather-adaptor", broker_info["ip"], broker_info["port"], None)
+    client.start()
+    return client
+
+
+# The received weather is forwarded in the background to the comma separated URLs
+# of WEATHER_TARGETS and, when CATALOG_URL is set, published on weather/<building>
+fanout = FanOut(
+    targets=[url for url in os.environ.get("WEATHER_TARGETS", "").split(",") if url],
+    mqtt_client=connect_mqtt(os.environ["CATALOG_URL"]) if os.environ.get("CATALOG_URL") else None
+)
 
 @app.route('/', methods=['GET'])
 def home():
@@ -19,18 +45,20 @@ def receive_json():
     """
     Endpoint pour recevoir des données JSON envoyées par weather.py.
     """
-    global received_data
     try:
         # Get entering JSON data
         received_data = request.get_json()
         if not received_data:
             return jsonify({"status": "error", "message": "No data received"}), 400
 
-        # Sanity check
-        print("Received JSON data (first line):", received_data[0])
+        try:
+            store.ingest(received_data)
+        except (ValueError, KeyError, TypeError) as e:
+            return jsonify({"status": "error", "message": f"Invalid data: {e}"}), 400
+        print(f"Received weather of {', '.join(weather_data['building_name'] for weather_data in received_data)}")
 
-        # Uncomment after to the target microservice:
-        # send_to_target_system(received_data)
+        # Only queued, the consumers are served by the fan-out threads
+        fanout.submit(received_data)
 
         return jsonify({"status": "success", "message": "Data received successfully"}), 200
     except Exception as e:
@@ -43,29 +71,39 @@ def get_data():
     """
     Endpoint pour afficher la première ligne des données JSON reçues.
     """
-    if received_data is None:
+    buildings = store.buildings()
+    if not buildings:
         return jsonify({"status": "error", "message": "No data received yet"}), 404
 
     # Show the first line for sanity check
-    return jsonify({"first_line": received_data[0]}), 200
+    return jsonify({"first_line": store.current(buildings[0])}), 200
 
 
-def send_to_target_system(data):
+@app.route('/weather', methods=['GET'])
+def get_weather():
     """
-    Fonction pour envoyer les données JSON au microservice cible.
+    Current weather and hourly forecast of a building: /weather?building=<name>&from=<time>&to=<time>
+    'from' and 'to' are ISO dates or epoch seconds. Without 'building', the current weather of every building.
     """
+    building = request.args.get("building")
+    if building is None:
+        return jsonify({name: store.current(name) for name in store.buildings()}), 200
+
     try:
-        # prepare to send JSONs
-        headers = {"Content-Type": "application/json"}
-        # Change  <TARGET_SYSTEM_URL> when we will have it
-        response = requests.post(TARGET_SYSTEM_URL, json=data, headers=headers)
-
-        if response.status_code == 200:
-            print("Data successfully sent to target system.")
-        else:
-            print(f"Failed to send data to target system. Status code: {response.status_code}, Response: {response.text}")
-    except Exception as e:
-        print(f"Error sending data to target system: {e}")
+        start = to_epoch(request.args["from"]) if "from" in request.args else None
+        end = to_epoch(request.args["to"]) if "to" in request.args else None
+    except ValueError:
+        return jsonify({"status": "error", "message": "'from' and 'to' must be ISO dates or epoch seconds"}), 400
+
+    hourly = store.hourly(building, start, end)
+    if hourly is None:
+        return jsonify({"status": "error", "message": f"Unknown building {building}"}), 404
+    return jsonify({"current": store.current(building), "hourly_weather": hourly}), 200
+
+
+@app.route('/weather/stats', methods=['GET'])
+def get_stats():
+    return jsonify(dict(store.stats, buildings=len(store.buildings()), fanout=fanout.stats)), 200
 
 
 if __name__ == "__main__":
@@ -1,60 +1,179 @@
 import openmeteo_requests
-import requests_cache
 from retry_requests import retry
+import numpy as np
 import pandas as pd
 import requests
 import json
+import threading
+import time
+from forecast_cache import ForecastCache
 
-# Setup the coordinates of the buildings
-locations = {
-    "Aule_I": {
-        "latitude": 45.065037,
-        "longitude": 7.658205,
-    }
-}
+# The buildings and their coordinates come from the rooms registered in the catalog
+CATALOG_URL = "http://localhost:8080"
+
+# The API updates its data every 15 minutes, polling more often would only use the quota
+DEFAULT_INTERVAL = 900
+# Polling interval in seconds of particular buildings, by building name
+BUILDING_INTERVALS = {}
+
+# Variables requested from the API, in the order of the response
+CURRENT_VARIABLES = ["temperature_2m", "precipitation", "wind_speed_10m", "wind_direction_10m"]
+HOURLY_VARIABLES = ["temperature_2m", "precipitation_probability", "wind_speed_10m", "wind_direction_10m"]
 
-# Setup the Open-Meteo API client with cache and retry on error
-cache_session = requests_cache.CachedSession('.cache', expire_after=3600)
-retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
+# Setup the Open-Meteo API client with retry on error, responses are cached by ForecastCache
+retry_session = retry(requests.Session(), retries=5, backoff_factor=0.2)
 openmeteo = openmeteo_requests.Client(session=retry_session)
 
 # Base URL for the API
 url = "https://api.open-meteo.com/v1/forecast"
 
+# URL of the adaptor
+ADAPTOR_URL = "http://localhost:5000/receive-json"
+
+# Forecast cache: locations closer than GRID degrees share an entry, fresh for
+# CACHE_TTL seconds and served while being refreshed until CACHE_STALE_TTL. The TTL
+# is shorter than every polling interval, so a due building finds its own previous
+# response stale and it is refreshed, unless a nearby building has just fetched it
+GRID = 0.01
+CACHE_TTL = max(min([DEFAULT_INTERVAL, *BUILDING_INTERVALS.values()]) - 60, 0)
+CACHE_STALE_TTL = 3600
+CACHE_SIZE = 256
+
+
+def fetch_forecasts(coordinates):
+    """Query the API once for a list of (latitude, longitude), one response per coordinate in order."""
+    query_params = {
+        "latitude": [latitude for latitude, _ in coordinates],
+        "longitude": [longitude for _, longitude in coordinates],
+        "current": CURRENT_VARIABLES,
+        "hourly": HOURLY_VARIABLES,
+        "forecast_days": 1
+    }
+    return openmeteo.weather_api(url, params=query_params)
+
+
 # Function to send the JSON to the adaptor
 def send_to_adaptor(data, adaptor_url):
     """
-    Sends JSON data directly to the adaptor endpoint with logs.
+    Sends JSON data directly to the adaptor endpoint with logs. Returns True on success.
     """
     try:
         print("Sending data to adaptor...")
         response = requests.post(adaptor_url, json=data, headers={"Content-Type": "application/json"})
         if response.status_code == 200:
             print("Data successfully sent to adaptor.")
-        else:
-            print(f"Failed to send data to adaptor. Status code: {response.status_code}, Response: {response.text}")
+            return True
+        print(f"Failed to send data to adaptor. Status code: {response.status_code}, Response: {response.text}")
     except Exception as e:
         print(f"Error while sending data to adaptor: {e}")
+    return False
 
 
-# URL of the adaptor
-ADAPTOR_URL = "http://localhost:5000/receive-json"
+def buildings_from_rooms(rooms):
+    """Coordinates of every building, from the first of its rooms that has some."""
+    locations = {}
+    for room in rooms:
+        coordinates = room.get("coordinates")
+        if coordinates and room["buildingName"] not in locations:
+            locations[room["buildingName"]] = {
+                "latitude": coordinates["lat"],
+                "longitude": coordinates["lon"],
+                "interval": BUILDING_INTERVALS.get(room["buildingName"], DEFAULT_INTERVAL)
+            }
+    return locations
 
-# List to store all weather data
-all_weather_data = []
 
-# Processing the locations and querying the API
-for building_name, building_data in locations.items():
-    query_params = {
-        "latitude": building_data["latitude"],
-        "longitude": building_data["longitude"],
-        "current": ["temperature_2m", "precipitation", "wind_speed_10m", "wind_direction_10m"],
-        "hourly": ["temperature_2m", "precipitation_probability", "wind_speed_10m", "wind_direction_10m"],
-        "forecast_days": 1
-    }
+class WeatherPoller:
+    """Poll the forecast of every building at its own cadence and send the adaptor what changed."""
+
+    def __init__(self, catalog_url, adaptor_url):
+        self.catalog_url = catalog_url
+        self.adaptor_url = adaptor_url
+        self.session = requests.Session()
+        self.locations = {}
+        self.rooms_etag = None
+        self.next_poll = {}
+        # Last forecast accepted by the adaptor: building -> (hour timestamps, values, current weather)
+        self.sent = {}
+        self.cache = ForecastCache(fetch_forecasts, ttl=CACHE_TTL, stale_ttl=CACHE_STALE_TTL,
+                                   capacity=CACHE_SIZE, grid=GRID, on_refresh=self.refreshed)
+        self._wake = threading.Event()
 
-    responses = openmeteo.weather_api(url, params=query_params)
-    for response in responses:
+    def refresh_locations(self):
+        """Update the buildings from the catalog rooms, a cheap 304 when no room changed."""
+        headers = {"If-None-Match": self.rooms_etag} if self.rooms_etag else {}
+        response = self.session.get(f"{self.catalog_url}/rooms", headers=headers, timeout=10)
+        if response.status_code == 304:
+            return
+        response.raise_for_status()
+        self.rooms_etag = response.headers.get("ETag")
+        locations = buildings_from_rooms(response.json())
+
+        for building_name in set(self.locations) - set(locations):
+            print(f"Building {building_name} removed")
+            self.next_poll.pop(building_name, None)
+            self.sent.pop(building_name, None)
+        for building_name, location in locations.items():
+            previous = self.locations.get(building_name)
+            if previous is None or (previous["latitude"], previous["longitude"]) != (location["latitude"], location["longitude"]):
+                print(f"Building {building_name} at {location['latitude']}, {location['longitude']}")
+                # New or moved, poll it right away
+                self.next_poll[building_name] = 0.0
+                self.sent.pop(building_name, None)
+        self.locations = locations
+
+    def fetch(self, building_names):
+        """Forecast of the given buildings, the locations that are not cached are queried in one API call."""
+        coordinates = [(self.locations[name]["latitude"], self.locations[name]["longitude"]) for name in building_names]
+        return dict(zip(building_names, self.cache.get_many(coordinates)))
+
+    def refreshed(self, keys):
+        """Poll again the buildings whose stale forecast has just been refreshed in the background."""
+        keys = set(keys)
+        for building_name, location in list(self.locations.items()):
+            if self.cache.key(location["latitude"], location["longitude"]) in keys:
+                self.next_poll[building_name] = 0.0
+        self._wake.set()
+
+    @staticmethod
+    def hourly_arrays(response):
+        """Return the hour timestamps and a (hours x variables) array of the hourly forecast."""
+        hourly = response.Hourly()
+        times = np.arange(hourly.Time(), hourly.TimeEnd(), hourly.Interval())
+        values = np.column_stack([hourly.Variables(i).ValuesAsNumpy() for i in range(len(HOURLY_VARIABLES))])
+        return times, values.astype(np.float64)
+
+    @staticmethod
+    def changed_hours(times, values, previous):
+        """Boolean mask of the hours that are new or differ from the previous forecast."""
+        changed = np.ones(len(times), dtype=bool)
+        if previous is None:
+            return changed
+        previous_times, previous_values = previous[0], previous[1]
+        _, index, previous_index = np.intersect1d(times, previous_times, return_indices=True)
+        new, old = values[index], previous_values[previous_index]
+        same = np.all((new == old) | (np.isnan(new) & np.isnan(old)), axis=1)
+        changed[index[same]] = False
+        return changed
+
+    def build_update(self, building_name, response):
+        """Return the payload of a building with only the hours that changed (None when nothing did) and its new state."""
+        current = response.Current()
+        current_weather = {"time": current.Time()}
+        for i, variable in enumerate(CURRENT_VARIABLES):
+            current_weather[variable] = float(current.Variables(i).Value())
+
+        times, values = self.hourly_arrays(response)
+        previous = self.sent.get(building_name)
+        changed = self.changed_hours(times, values, previous)
+        if not changed.any() and previous is not None and previous[2] == current_weather:
+            return None, (times, values, current_weather)
+
+        hours = pd.to_datetime(times[changed], unit="s", utc=True).astype(str)
+        hourly_weather = [
+            {"time": hour, **dict(zip(HOURLY_VARIABLES, row))}
+            for hour, row in zip(hours, values[changed].tolist())
+        ]
         weather_data = {
             "building_name": building_name,
             "coordinates": {
@@ -67,47 +186,71 @@ for building_name, building_data in locations.items():
                 "abbreviation": response.TimezoneAbbreviation(),
                 "utc_offset_seconds": response.UtcOffsetSeconds()
             },
-            "current_weather": {},
-            "hourly_weather": []
+            "current_weather": current_weather,
+            "hourly_weather": hourly_weather
         }
+        return weather_data, (times, values, current_weather)
 
-        # Actual data
-        current = response.Current()
-        weather_data["current_weather"] = {
-            "time": current.Time(),
-            "temperature_2m": float(current.Variables(0).Value()),
-            "precipitation": float(current.Variables(1).Value()),
-            "wind_speed_10m": float(current.Variables(2).Value()),
-            "wind_direction_10m": float(current.Variables(3).Value())
-        }
+    def poll(self):
+        """Fetch the buildings that are due and send the changes. Returns the seconds until the next poll."""
+        try:
+            self.refresh_locations()
+        except Exception as e:
+            # Go on with the buildings already known
+            print(f"Error while reading the buildings from the catalog: {e}")
+        if not self.next_poll:
+            print("No building with coordinates in the catalog")
+            return 60
 
-        # Hourly data process
-        hourly = response.Hourly()
-        hourly_dates = pd.date_range(
-            start=pd.to_datetime(hourly.Time(), unit="s", utc=True),
-            end=pd.to_datetime(hourly.TimeEnd(), unit="s", utc=True),
-            freq=pd.Timedelta(seconds=hourly.Interval()),
-            inclusive="left"
-        )
-        hourly_data = {
-            "temperature_2m": [float(val) for val in hourly.Variables(0).ValuesAsNumpy()],
-            "precipitation_probability": [float(val) for val in hourly.Variables(1).ValuesAsNumpy()],
-            "wind_speed_10m": [float(val) for val in hourly.Variables(2).ValuesAsNumpy()],
-            "wind_direction_10m": [float(val) for val in hourly.Variables(3).ValuesAsNumpy()]
-        }
+        now = time.time()
+        due = [name for name, next_poll in self.next_poll.items() if next_poll <= now]
+        if due:
+            # Set before fetching, a background refresh finishing meanwhile makes them due again
+            for building_name in due:
+                self.next_poll[building_name] = now + self.locations[building_name]["interval"]
+            try:
+                responses = self.fetch(due)
+            except Exception as e:
+                print(f"Error while fetching the weather of {', '.join(due)}: {e}")
+                for building_name in due:
+                    self.next_poll[building_name] = now + 60
+                return 60
+
+            updates, states = [], {}
+            for building_name, response in responses.items():
+                location = self.locations[building_name]
+                if self.cache.refreshing(location["latitude"], location["longitude"]):
+                    # Stale, the poll triggered by the refresh sends the new data
+                    continue
+                update, states[building_name] = self.build_update(building_name, response)
+                if update:
+                    updates.append(update)
 
-        # Add hourly data in the json
-        for i, date in enumerate(hourly_dates):
-            weather_data["hourly_weather"].append({
-                "time": str(date),
-                "temperature_2m": hourly_data["temperature_2m"][i],
-                "precipitation_probability": hourly_data["precipitation_probability"][i],
-                "wind_speed_10m": hourly_data["wind_speed_10m"][i],
-                "wind_direction_10m": hourly_data["wind_direction_10m"][i]
-            })
-
-        # Add to global json
-        all_weather_data.append(weather_data)
-
-# Send the data to the adaptors
-send_to_adaptor(all_weather_data, ADAPTOR_URL)
+            print(f"Forecast cache hit rate: {self.cache.hit_rate(stale=False):.0%} fresh, "
+                  f"{self.cache.hit_rate():.0%} without waiting for the API, {self.cache.stats['upstreamCalls']} API calls")
+            if not states:
+                print(f"Refreshing the weather of {', '.join(due)}")
+            elif not updates:
+                print(f"No change in the weather of {', '.join(states)}")
+                self.sent.update(states)
+            elif send_to_adaptor(updates, self.adaptor_url):
+                self.sent.update(states)
+            else:
+                # Keep the old state so that the same hours are sent again next time
+                for building_name in due:
+                    self.next_poll[building_name] = now + 60
+        # Also wake up regularly to pick up the buildings added to the catalog
+        return min(max(min(self.next_poll.values()) - time.time(), 1), 60)
+
+    def run(self):
+        while True:
+            self._wake.wait(self.poll())
+            self._wake.clear()
+
+
+if __name__ == "__main__":
+    poller = WeatherPoller(CATALOG_URL, ADAPTOR_URL)
+    try:
+        poller.run()
+    except KeyboardInterrupt:
+        print("Weather poller stopped.")
@@ -0,0 +1,154 @@
+import bisect
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+
+def to_epoch(value):
+    """Seconds since the epoch of an ISO date ('2025-01-17 10:00:00+00:00') or a number."""
+    if isinstance(value, (int, float)):
+        return int(value)
+    try:
+        return int(float(value))
+    except ValueError:
+        return int(datetime.fromisoformat(value).timestamp())
+
+
+class WeatherStore:
+    """Hourly weather of every building, indexed by building and hour.
+
+    Each building keeps at most max_hours hours in memory, in a dict for the
+    upserts and a sorted list of hours for range queries. The "current" snapshot
+    of a building is rebuilt when its data arrives, so reading it costs a lookup.
+    With a db_path the data is also written to SQLite and loaded back on startup.
+    """
+
+    def __init__(self, max_hours=24 * 14, db_path=None):
+        self.max_hours = max_hours
+        self._lock = threading.Lock()
+        self._hours = {}  # building -> {hour: row}
+        self._index = {}  # building -> sorted hours
+        self._info = {}  # building -> coordinates, elevation, timezone
+        self._current = {}  # building -> snapshot
+        self.stats = {"updates": 0, "hoursStored": 0, "evicted": 0}
+
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS weather_hourly "
+                             "(building TEXT, hour INTEGER, data TEXT, PRIMARY KEY (building, hour))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS weather_buildings "
+                             "(building TEXT PRIMARY KEY, info TEXT, current TEXT)")
+            self._db.commit()
+            self._load()
+
+    def _load(self):
+        for building, info, current in self._db.execute("SELECT building, info, current FROM weather_buildings"):
+            self._info[building] = json.loads(info)
+            self._info[building]["current_weather"] = json.loads(current)
+            self._hours[building] = {}
+            self._index[building] = []
+        rows = self._db.execute("SELECT building, hour, data FROM weather_hourly ORDER BY building, hour")
+        for building, hour, data in rows:
+            self._hours.setdefault(building, {})[hour] = json.loads(data)
+            self._index.setdefault(building, []).append(hour)
+            self.stats["hoursStored"] += 1
+        for building in list(self._hours):
+            # max_hours may have been lowered since the hours were written
+            evicted = self._evict(building)
+            if evicted is not None:
+                self._db.execute("DELETE FROM weather_hourly WHERE building = ? AND hour <= ?", (building, evicted))
+            self._snapshot(building)
+        self._db.commit()
+
+    def ingest(self, payload):
+        """Merge the buildings sent by weather.py, only their changed hours are expected."""
+        if not isinstance(payload, list):
+            raise ValueError("Expected a list of buildings")
+        with self._lock:
+            for weather_data in payload:
+                building = weather_data["building_name"]
+                hours = self._hours.setdefault(building, {})
+                index = self._index.setdefault(building, [])
+                self._info[building] = {
+                    "coordinates": weather_data.get("coordinates"),
+                    "elevation": weather_data.get("elevation"),
+                    "timezone": weather_data.get("timezone"),
+                    "current_weather": weather_data.get("current_weather")
+                }
+
+                rows = []
+                for row in weather_data.get("hourly_weather", []):
+                    hour = to_epoch(row["time"])
+                    if hour not in hours:
+                        bisect.insort(index, hour)
+                        self.stats["hoursStored"] += 1
+                    hours[hour] = row
+                    rows.append((building, hour, json.dumps(row)))
+                evicted = self._evict(building)
+                self._snapshot(building)
+                self.stats["updates"] += 1
+
+                if self._db:
+                    info = {key: value for key, value in self._info[building].items() if key != "current_weather"}
+                    self._db.execute("INSERT OR REPLACE INTO weather_buildings VALUES (?, ?, ?)",
+                                     (building, json.dumps(info), json.dumps(self._info[building]["current_weather"])))
+                    self._db.executemany("INSERT OR REPLACE INTO weather_hourly VALUES (?, ?, ?)", rows)
+                    if evicted is not None:
+                        self._db.execute("DELETE FROM weather_hourly WHERE building = ? AND hour <= ?", (building, evicted))
+            if self._db:
+                self._db.commit()
+
+    def _evict(self, building):
+        """Drop the oldest hours beyond max_hours, return the last dropped hour."""
+        index = self._index[building]
+        extra = len(index) - self.max_hours
+        if extra <= 0:
+            return None
+        hours = self._hours[building]
+        for hour in index[:extra]:
+            del hours[hour]
+        last = index[extra - 1]
+        del index[:extra]
+        self.stats["evicted"] += extra
+        self.stats["hoursStored"] -= extra
+        return last
+
+    def _snapshot(self, building):
+        """Precompute what GET /weather returns as the current weather of a building."""
+        index = self._index.get(building, [])
+        current_weather = self._info.get(building, {}).get("current_weather")
+        next_hour = None
+        if current_weather and "time" in current_weather:
+            # First forecast hour after the current conditions
+            position = bisect.bisect_right(index, to_epoch(current_weather["time"]))
+            if position < len(index):
+                next_hour = self._hours[building][index[position]]
+        self._current[building] = dict(self._info.get(building, {}), building_name=building, next_hour=next_hour)
+
+    def buildings(self):
+        with self._lock:
+            return list(self._current)
+
+    def current(self, building):
+        """Current snapshot of a building, or None when it is unknown."""
+        with self._lock:
+            return self._current.get(building)
+
+    def hourly(self, building, start=None, end=None):
+        """Hours of a building between start and end included, in order, None when the building is unknown."""
+        with self._lock:
+            index = self._index.get(building)
+            if index is None:
+                return None
+            low = 0 if start is None else bisect.bisect_left(index, start)
+            high = len(index) if end is None else bisect.bisect_right(index, end)
+            hours = self._hours[building]
+            return [hours[hour] for hour in index[low:high]]
+
+    def close(self):
+        if self._db:
+            with self._lock:
+                self._db.close()
+                self._db = None